@@ -1,23 +1,400 @@
 # agent/agent.py
 import subprocess
 import os
+import signal
 import time
 import threading
 import queue
 import json
+import hashlib
 from flask import Flask, request, jsonify, Response, stream_with_context
+import agent_metrics
+from agent_metrics import CommandRun
 
 app = Flask(__name__)
 
 # Configuration
 # The volume mount in docker-compose.yml maps ./agent to /agent_files inside the container.
-PREDEFINED_COMMANDS_DIR = "/agent_files/predefined_commands"
+PREDEFINED_COMMANDS_DIR = os.environ.get("PREDEFINED_COMMANDS_DIR", "/agent_files/predefined_commands")
 AGENT_PORT = int(os.environ.get("AGENT_PORT", 9000)) # Port to listen on
+AGENT_MODE = os.environ.get("AGENT_MODE", "threaded") # "threaded" (Flask) or "async" (see async_agent.py)
+HEARTBEAT_INTERVAL = 10 # Seconds of silence after which a heartbeat line is sent
+# Formatted lines waiting to be sent to one client. When the client falls behind,
+# the readers stop draining the command's pipes, so memory per command stays bounded.
+STREAM_QUEUE_SIZE = int(os.environ.get("STREAM_QUEUE_SIZE", 256))
+# Most lines (or bytes) sent to the client in one write
+STREAM_BATCH_LINES = int(os.environ.get("STREAM_BATCH_LINES", 256))
+STREAM_BATCH_BYTES = int(os.environ.get("STREAM_BATCH_BYTES", 64 * 1024))
+# Longest a command may run (seconds) before it is stopped with reason "timeout"; 0 for no limit
+COMMAND_MAX_RUNTIME = float(os.environ.get("COMMAND_MAX_RUNTIME", 3600))
+# Per-command limits, e.g. COMMAND_MAX_RUNTIMES='{"long_running_task.sh": 120}'
+COMMAND_MAX_RUNTIMES = json.loads(os.environ.get("COMMAND_MAX_RUNTIMES", "{}"))
+# Seconds a stopped command gets between SIGTERM and SIGKILL
+STOP_GRACE_PERIOD = float(os.environ.get("STOP_GRACE_PERIOD", 5))
+# How often (seconds) the command catalog checks PREDEFINED_COMMANDS_DIR for changes
+CATALOG_REFRESH_INTERVAL = float(os.environ.get("CATALOG_REFRESH_INTERVAL", 2))
+
+# Admission control: at most AGENT_MAX_CONCURRENCY commands run at once and at most
+# AGENT_MAX_QUEUE more wait (for up to AGENT_QUEUE_TIMEOUT seconds) for a free slot.
+# Anything beyond that is refused with 429 and a Retry-After of AGENT_RETRY_AFTER seconds.
+AGENT_MAX_CONCURRENCY = int(os.environ.get("AGENT_MAX_CONCURRENCY", 8))
+AGENT_MAX_QUEUE = int(os.environ.get("AGENT_MAX_QUEUE", 32))
+AGENT_QUEUE_TIMEOUT = float(os.environ.get("AGENT_QUEUE_TIMEOUT", 30))
+AGENT_RETRY_AFTER = int(os.environ.get("AGENT_RETRY_AFTER", 5))
+
+class AdmissionController:
+    """Limits how many commands run at once, with a bounded wait queue."""
+
+    def __init__(self, max_running, max_waiting, wait_timeout):
+        self.max_running = max_running
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.running = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Take a slot, waiting in the queue if needed. Returns False if refused."""
+        with self._condition:
+            if self.running < self.max_running:
+                self.running += 1
+                return True
+            if self.waiting >= self.max_waiting:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            try:
+                admitted = self._condition.wait_for(
+                    lambda: self.running < self.max_running, timeout=self.wait_timeout
+                )
+            finally:
+                self.waiting -= 1
+            if not admitted:
+                self.rejected += 1
+                return False
+            self.running += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self.running -= 1
+            self._condition.notify()
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "queued": self.waiting,
+            "max_concurrency": self.max_running,
+            "max_queue": self.max_waiting,
+            "rejected": self.rejected
+        }
+
+admission = AdmissionController(AGENT_MAX_CONCURRENCY, AGENT_MAX_QUEUE, AGENT_QUEUE_TIMEOUT)
+
+def busy_response_body():
+    return {"error": "Agent is at capacity, retry later", "retry_after": AGENT_RETRY_AFTER}
+
+def max_runtime(command_name):
+    """Seconds `command_name` may run before it is stopped; 0 for no limit."""
+    return float(COMMAND_MAX_RUNTIMES.get(command_name, COMMAND_MAX_RUNTIME))
+
+def signal_group(process, sig):
+    """Send `sig` to the process group of a command started with start_new_session=True."""
+    try:
+        os.killpg(process.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass  # already gone
+
+class StopHandle:
+    """
+    Stops one command: SIGTERM to its whole process group, then SIGKILL if it
+    is still running STOP_GRACE_PERIOD seconds later. The first reason given
+    ("cancelled" or "timeout") is kept and reported in the exit record.
+    """
+
+    def __init__(self, process):
+        self.process = process
+        self.reason = None
+        self._deadline = None
+        self._lock = threading.Lock()
+
+    def running(self):
+        return self.process.poll() is None
+
+    def later(self, delay, callback):
+        timer = threading.Timer(delay, callback)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def __call__(self, reason):
+        with self._lock:
+            if self.reason is not None or not self.running():
+                return
+            self.reason = reason
+        signal_group(self.process, signal.SIGTERM)
+        self.later(STOP_GRACE_PERIOD, self.kill)
+
+    def kill(self):
+        if self.running():
+            signal_group(self.process, signal.SIGKILL)
+
+    def arm(self, seconds):
+        """Stop the command with reason "timeout" after `seconds` (0 for never)."""
+        if seconds > 0:
+            self._deadline = self.later(seconds, lambda: self("timeout"))
+
+    def disarm(self):
+        if self._deadline is not None:
+            self._deadline.cancel()
+
+class RunningCommands:
+    """Stop handles of the commands running for each execution id, for /cancel."""
+
+    def __init__(self):
+        self._handles = {}
+        self._lock = threading.Lock()
+
+    def add(self, execution_id, handle):
+        if execution_id is not None:
+            with self._lock:
+                self._handles[str(execution_id)] = handle
+
+    def discard(self, execution_id, handle):
+        if execution_id is not None:
+            with self._lock:
+                if self._handles.get(str(execution_id)) is handle:
+                    del self._handles[str(execution_id)]
+
+    def stop(self, execution_id, reason="cancelled"):
+        """Stop the execution's command. Returns False if none is running here."""
+        with self._lock:
+            handle = self._handles.get(str(execution_id))
+        if handle is None:
+            return False
+        handle(reason)
+        return True
+
+running_commands = RunningCommands()
+
+class CommandCatalog:
+    """
+    In-memory index of the scripts in PREDEFINED_COMMANDS_DIR.
+
+    The directory is rescanned at most every CATALOG_REFRESH_INTERVAL seconds.
+    A rescan only stats the files; a script is hashed and made executable
+    again only when its size or mtime changed, so /execute no longer touches
+    the filesystem for every call.
+    """
+
+    def __init__(self, directory, refresh_interval):
+        self.directory = os.path.normpath(directory)
+        self.refresh_interval = refresh_interval
+        self.commands = {}
+        self.version = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def refresh(self, force=False):
+        """Rescan the directory if the last scan is older than refresh_interval."""
+        now = time.monotonic()
+        if not force and self._checked_at is not None and now - self._checked_at < self.refresh_interval:
+            return
+        with self._lock:
+            if not force and self._checked_at is not None and now - self._checked_at < self.refresh_interval:
+                return
+            self._scan()
+            self._checked_at = now
+
+    def _scan(self):
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError as e:
+            app.logger.error(f"Could not read predefined commands directory {self.directory}: {e}")
+            entries = []
+
+        commands = {}
+        for entry in entries:
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except OSError:
+                continue
+            previous = self.commands.get(entry.name)
+            if previous and previous['size'] == stat.st_size and previous['mtime'] == stat.st_mtime:
+                commands[entry.name] = previous
+                continue
+            commands[entry.name] = self._describe(entry.path, entry.name, stat)
+
+        if commands != self.commands:
+            self.commands = commands
+            # Changes whenever a script is added, removed or edited
+            digest = hashlib.sha256()
+            for name in sorted(commands):
+                digest.update(f"{name}:{commands[name]['sha256']}\n".encode())
+            self.version = digest.hexdigest()[:16]
+            app.logger.info(f"Command catalog updated: {sorted(commands)}")
+
+    def _describe(self, path, name, stat):
+        """Build the catalog entry for one script."""
+        # Ensure the script is executable (Docker images might not preserve this from host)
+        try:
+            os.chmod(path, 0o755) # rwxr-xr-x
+        except OSError as e:
+            app.logger.error(f"Could not set executable bit on {path}: {e}")
+            # Continue, as it might already be executable or run via sh
+
+        digest = hashlib.sha256()
+        try:
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(65536), b''):
+                    digest.update(block)
+        except OSError as e:
+            app.logger.error(f"Could not hash {path}: {e}")
+
+        return {
+            'name': name,
+            'path': path,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha256': digest.hexdigest(),
+            'streaming': name.endswith(".sh")
+        }
+
+    def get(self, command_name):
+        """Return the catalog entry for a command, or None."""
+        self.refresh()
+        return self.commands.get(command_name)
+
+    def describe(self):
+        """The catalog as served on /commands."""
+        self.refresh()
+        return {
+            'host': os.uname()[1],
+            'version': self.version,
+            'commands': [
+                {key: value for key, value in entry.items() if key != 'path'}
+                for _, entry in sorted(self.commands.items())
+            ]
+        }
+
+catalog = CommandCatalog(PREDEFINED_COMMANDS_DIR, CATALOG_REFRESH_INTERVAL)
+
+def resolve_script(command_name):
+    """
+    Map a command name to its script inside PREDEFINED_COMMANDS_DIR.
+    Returns (path, None, None) or (None, error_message, http_status).
+    """
+    entry = catalog.get(command_name)
+    if entry is not None:
+        return entry['path'], None, None
+
+    # Security: anything that isn't a catalog entry is refused; report path traversal attempts
+    normalized_script_path = os.path.normpath(os.path.join(PREDEFINED_COMMANDS_DIR, command_name))
+    if not normalized_script_path.startswith(os.path.normpath(PREDEFINED_COMMANDS_DIR) + os.sep):
+        app.logger.error(f"Attempt to access non-predefined command path: {command_name}")
+        return None, "Command not allowed or path traversal attempt", 403
+
+    app.logger.error(f"Command script not found or not a file: {normalized_script_path}")
+    return None, f"Command '{command_name}' not found or is not a file.", 404
+
+def build_command(command_name, script_path, params):
+    """Construct the argv used to run a predefined command."""
+    if command_name.endswith(".sh"):
+        return ['/bin/sh', script_path] + params
+    return [script_path] + params
+
+_clock = (None, None)  # (epoch second, "HH:MM:SS")
+
+def clock():
+    """The current time as HH:MM:SS, formatted at most once per second."""
+    global _clock
+    second = int(time.time())
+    cached_second, text = _clock
+    if second != cached_second:
+        text = time.strftime('%H:%M:%S', time.localtime(second))
+        _clock = (second, text)
+    return text
+
+def format_line(stream_name, text):
+    """Format one line of output the way workers expect it."""
+    return f"[{clock()}] [{stream_name}] {text}"
+
+# Framed streaming protocol: one JSON record per line, sent to workers that ask for it with
+#   Accept: application/x-ndjson
+# Records: {"t": "out", "s": "stdout"|"stderr", "ts": <epoch>, "d": <line>}
+#          {"t": "hb", "ts": <epoch>}              heartbeat while the command is silent
+#          {"t": "exit", "code": <int>, "ts": <epoch>}  always the last record of a finished run;
+#                                                       has "reason": "cancelled"|"timeout" if the agent stopped it
+#          {"t": "err", "d": <message>, "ts": <epoch>}  the agent failed to run the command
+# Older workers get the plain "[HH:MM:SS] [STDOUT] ..." lines.
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+def wants_frames(accept_header):
+    """True if the client asked for the framed protocol."""
+    return NDJSON_MIMETYPE in (accept_header or "")
+
+def encode_frame(record):
+    return json.dumps(record, separators=(',', ':'))
+
+def output_record(stream_name, text, framed):
+    """One line of command output, as a frame or a legacy text line."""
+    if framed:
+        return encode_frame({"t": "out", "s": stream_name.lower(), "ts": round(time.time(), 3), "d": text})
+    return format_line(stream_name, text)
+
+def heartbeat_record(framed):
+    if framed:
+        return encode_frame({"t": "hb", "ts": round(time.time(), 3)})
+    return " "  # Space keeps the connection alive but doesn't display
+
+def exit_record(command_name, exit_code, framed, reason=None):
+    """The last record of a run. `reason` is "cancelled" or "timeout" if the agent stopped the command."""
+    if framed:
+        record = {"t": "exit", "code": exit_code, "ts": round(time.time(), 3)}
+        if reason:
+            record["reason"] = reason
+        return encode_frame(record)
+    stopped = f" was stopped ({reason}) and" if reason else ""
+    return format_line("INFO", f"Command '{command_name}'{stopped} completed with exit code {exit_code}")
+
+def error_record(message, framed):
+    if framed:
+        return encode_frame({"t": "err", "d": message, "ts": round(time.time(), 3)})
+    return f"[ERROR] Exception during execution: {message}"
 
 @app.route('/health', methods=['GET'])
 def health_check():
-    """Health check endpoint for the agent."""
-    return jsonify({"status": "healthy", "message": f"Agent on {os.uname()[1]} is up."}), 200
+    """Health check endpoint for the agent, including how busy it is."""
+    return jsonify({
+        "status": "healthy",
+        "message": f"Agent on {os.uname()[1]} is up.",
+        "admission": admission.stats()
+    }), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics: running commands, durations, output rates and admission."""
+    return Response(agent_metrics.render(), content_type=agent_metrics.CONTENT_TYPE)
+
+@app.route('/cancel/<execution_id>', methods=['POST'])
+def cancel_command(execution_id):
+    """
+    Stops the command running for an execution: its process group gets
+    SIGTERM, then SIGKILL after STOP_GRACE_PERIOD seconds. The stream of that
+    run then ends with an exit record whose reason is "cancelled".
+    """
+    if not running_commands.stop(execution_id, "cancelled"):
+        return jsonify({"error": f"No command is running for execution {execution_id}"}), 404
+    app.logger.info(f"Cancelling the command of execution {execution_id}")
+    return jsonify({"execution_id": execution_id, "status": "cancelling"}), 202
+
+@app.route('/commands', methods=['GET'])
+def list_commands():
+    """The predefined commands this agent can run, with size, mtime and content hash."""
+    return jsonify(catalog.describe()), 200
 
 @app.route('/execute', methods=['POST'])
 def execute_command():
@@ -32,87 +409,107 @@ def execute_command():
     command_name = data['command_name']
     params = data.get('params', []) # Optional parameters for the script
     stream_output = data.get('stream_output', False) # Whether to stream real-time output
+    execution_id = data.get('execution_id') # Lets /cancel find the command
 
-    # Security: Construct the full path and ensure it's within the predefined directory
-    script_path = os.path.join(PREDEFINED_COMMANDS_DIR, command_name)
-
-    # Normalize path to prevent directory traversal (e.g., ../../etc/passwd)
-    normalized_script_path = os.path.normpath(script_path)
-
-    if not normalized_script_path.startswith(os.path.normpath(PREDEFINED_COMMANDS_DIR) + os.sep):
-        app.logger.error(f"Attempt to access non-predefined command path: {script_path}")
-        return jsonify({"error": "Command not allowed or path traversal attempt"}), 403
-
-    if not os.path.exists(normalized_script_path) or not os.path.isfile(normalized_script_path):
-        app.logger.error(f"Command script not found or not a file: {normalized_script_path}")
-        return jsonify({"error": f"Command '{command_name}' not found or is not a file."}), 404
-
-    # Ensure the script is executable (Docker images might not preserve this from host)
-    try:
-        os.chmod(normalized_script_path, 0o755) # rwxr-xr-x
-    except OSError as e:
-        app.logger.error(f"Could not set executable bit on {normalized_script_path}: {e}")
-        # Continue, as it might already be executable or run via sh
+    normalized_script_path, error, status = resolve_script(command_name)
+    if error:
+        return jsonify({"error": error}), status
 
     # Construct the command to execute.
-    if command_name.endswith(".sh"):
-        full_command = ['/bin/sh', normalized_script_path] + params
-    else:
-        full_command = [normalized_script_path] + params
+    full_command = build_command(command_name, normalized_script_path, params)
+
+    # Wait for a free slot, or tell the caller to come back later
+    if not admission.acquire():
+        app.logger.warning(f"Refusing '{command_name}': {admission.stats()}")
+        response = jsonify(busy_response_body())
+        response.headers['Retry-After'] = str(AGENT_RETRY_AFTER)
+        return response, 429
 
     app.logger.info(f"Executing command: {' '.join(full_command)}")
     
     # For all shell scripts or when explicitly requested, use streaming
     if command_name.endswith(".sh") or stream_output:
-        return stream_command_output(full_command, command_name)
+        try:
+            response = stream_command_output(
+                full_command, command_name, wants_frames(request.headers.get('Accept')), execution_id
+            )
+        except Exception:
+            admission.release()
+            raise
+        # The slot is held until the stream is finished or the client goes away
+        response.call_on_close(admission.release)
+        return response
     
     # For non-shell commands, use the standard execution approach
     try:
-        # Execute the command
+        # Execute the command in its own process group, so stopping it stops its children too
         process = subprocess.Popen(
             full_command,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            text=True # Decodes stdout/stderr to strings
+            text=True, # Decodes stdout/stderr to strings
+            start_new_session=True
         )
-        stdout, stderr = process.communicate(timeout=300) # Add a timeout
+        run = CommandRun(command_name)
+        stop = StopHandle(process)
+        stop.arm(max_runtime(command_name))
+        running_commands.add(execution_id, stop)
+        stdout, stderr = process.communicate()
         exit_code = process.returncode
+        run.finish(exit_code, stop.reason)
+
+        if stop.reason == "timeout":
+            app.logger.error(f"Command '{command_name}' timed out.")
+            return jsonify({
+                "error": "Command timed out",
+                "command": command_name,
+                "stdout": stdout,
+                "stderr": stderr,
+                "exit_code": exit_code,
+                "stopped": stop.reason
+            }), 504 # Gateway Timeout might be appropriate
 
         app.logger.info(f"Command '{command_name}' completed with exit code {exit_code}") 
         if stderr:
              app.logger.error(f"Stderr: {stderr}")
 
-        return jsonify({
+        result = {
             "command": command_name,
             "stdout": stdout,
             "stderr": stderr,
             "exit_code": exit_code
-        }), 200
+        }
+        if stop.reason:
+            result["stopped"] = stop.reason
+        return jsonify(result), 200
 
     except FileNotFoundError:
         app.logger.error(f"Script {normalized_script_path} not found during Popen.")
         return jsonify({"error": f"Script {command_name} not found. Check agent logs."}), 500
-    except subprocess.TimeoutExpired:
-        app.logger.error(f"Command '{command_name}' timed out.")
-        process.kill()
-        stdout, stderr = process.communicate()
-        return jsonify({
-            "error": "Command timed out",
-            "command": command_name,
-            "stdout": stdout,
-            "stderr": stderr,
-            "exit_code": -1 # Or a specific timeout code
-        }), 504 # Gateway Timeout might be appropriate
     except Exception as e:
         app.logger.error(f"Error executing command '{command_name}': {str(e)}")
         return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+    finally:
+        if 'stop' in locals():
+            stop.disarm()
+            running_commands.discard(execution_id, stop)
+        if 'run' in locals():
+            run.finish()
+        admission.release()
 
-def stream_command_output(command, command_name):
+def stream_command_output(command, command_name, framed=False, execution_id=None):
     """
     Stream command output in real-time using a generator function.
+    With framed=True the output is sent as NDJSON records (see output_record).
+    The command can be stopped through /cancel/<execution_id> and is stopped
+    once it has run for max_runtime(command_name) seconds.
     """
     def generate():
         process = None
+        run = None
+        stop = None
+        output_queue = None
+        readers = []
         try:
             # Set environment variables to prevent buffering
             env = os.environ.copy()
@@ -125,116 +522,117 @@ def stream_command_output(command, command_name):
                 stderr=subprocess.PIPE,
                 text=True,
                 bufsize=0,  # Unbuffered
-                env=env
+                env=env,
+                start_new_session=True  # Own process group, so stopping it stops its children too
             )
+            run = CommandRun(command_name)
+            stop = StopHandle(process)
+            stop.arm(max_runtime(command_name))
+            running_commands.add(execution_id, stop)
             
-            # Queue for collecting output
-            output_queue = queue.Queue()
-            collected_stdout = []
-            collected_stderr = []
+            # Formatted lines on their way to the client; None marks the end of a pipe
+            output_queue = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
             
-            # Thread function to read output streams
-            def read_output(stream, output_list, stream_name):
-                for line in iter(stream.readline, ''):
-                    timestamp = time.strftime("%H:%M:%S")
-                    formatted_line = f"[{timestamp}] [{stream_name}] {line.rstrip()}"
-                    output_list.append(line)
-                    output_queue.put(formatted_line)
-                stream.close()
+            # Thread function to read output streams. Blocks while the queue is
+            # full, which in turn makes the command wait on its pipe.
+            def read_output(stream, stream_name):
+                try:
+                    for line in iter(stream.readline, ''):
+                        run.line(stream_name.lower(), len(line))
+                        output_queue.put(output_record(stream_name, line.rstrip(), framed))
+                finally:
+                    stream.close()
+                    output_queue.put(None)
             
             # Start threads to read stdout and stderr
-            stdout_thread = threading.Thread(
-                target=read_output, 
-                args=(process.stdout, collected_stdout, "STDOUT"),
-                daemon=True
-            )
-            stderr_thread = threading.Thread(
-                target=read_output, 
-                args=(process.stderr, collected_stderr, "STDERR"),
-                daemon=True
-            )
-            
-            stdout_thread.start()
-            stderr_thread.start()
-            
-            # Track all emitted lines for final output
-            all_emitted_lines = []
-            
-            # Record initial message in logs but don't send to client
-            initial_message = f"[{time.strftime('%H:%M:%S')}] [INFO] Starting execution of '{command_name}'..."
-            all_emitted_lines.append(initial_message)
-            # Don't yield to client: yield initial_message + "\n"
+            readers = [
+                threading.Thread(target=read_output, args=(process.stdout, "STDOUT"), daemon=True),
+                threading.Thread(target=read_output, args=(process.stderr, "STDERR"), daemon=True),
+            ]
+            for reader in readers:
+                reader.start()
             
-            # Flag to track if we're showing "waiting" messages
-            shown_waiting = False
-            last_output_time = time.time()
-            last_heartbeat_time = time.time()
-            
-            # Yield available output lines
-            while process.poll() is None or not output_queue.empty():
+            # Yield output until both pipes are drained, so the exit record
+            # always comes after the last line of output
+            open_streams = len(readers)
+            last_sent_time = time.monotonic()
+            while open_streams:
                 try:
-                    line = output_queue.get(timeout=0.1)
-                    all_emitted_lines.append(line)
-                    yield line + "\n"
-                    last_output_time = time.time()
-                    last_heartbeat_time = time.time()
-                    shown_waiting = False
+                    line = output_queue.get(timeout=0.5)
                 except queue.Empty:
-                    current_time = time.time()
-                    
-                    # If it's been more than 30 seconds since last output and process is still running
-                    if current_time - last_output_time > 30 and process.poll() is None and not shown_waiting:
-                        # Don't yield the "Still waiting" info message, just record for logs
-                        waiting_msg = f"[{time.strftime('%H:%M:%S')}] [INFO] Still waiting for output..."
-                        all_emitted_lines.append(waiting_msg)
-                        # Don't send to client: yield waiting_msg + "\n"
-                        shown_waiting = True
-                        last_heartbeat_time = current_time
-                    
                     # Send a heartbeat every 10 seconds to keep the connection alive
-                    if current_time - last_heartbeat_time >= 10 and process.poll() is None:
-                        yield " \n"  # Space + newline keeps connection alive but doesn't display
-                        last_heartbeat_time = current_time
-                    
-                    time.sleep(0.2) # Check more frequently
-            
-            # Wait for process to complete and threads to finish
-            stdout_thread.join(timeout=2)
-            stderr_thread.join(timeout=2)
-            
-            # Send final status
-            exit_code = process.returncode
-            final_status = f"[{time.strftime('%H:%M:%S')}] [INFO] Command '{command_name}' completed with exit code {exit_code}"
-            all_emitted_lines.append(final_status)
-            yield final_status + "\n"
+                    if time.monotonic() - last_sent_time >= HEARTBEAT_INTERVAL:
+                        yield heartbeat_record(framed) + "\n"
+                        last_sent_time = time.monotonic()
+                    continue
+                
+                # Send whatever else is already waiting along with this line
+                batch = []
+                batch_bytes = 0
+                while True:
+                    if line is None:
+                        open_streams -= 1
+                    else:
+                        batch.append(line)
+                        batch_bytes += len(line)
+                    if len(batch) >= STREAM_BATCH_LINES or batch_bytes >= STREAM_BATCH_BYTES:
+                        break
+                    try:
+                        line = output_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                if batch:
+                    yield "\n".join(batch) + "\n"
+                    last_sent_time = time.monotonic()
             
-            # After streaming, send the complete data as JSON
-            # complete_data = {
-            #     "command": command_name,
-            #     "stdout": "\n".join(all_emitted_lines),  # Include all formatted output
-            #     "raw_stdout": "".join(collected_stdout),  # Also include raw output
-            #     "stderr": "".join(collected_stderr),
-            #     "exit_code": exit_code
-            # }
+            # Both pipes are closed; wait for the process itself to exit
+            exit_code = process.wait()
+            run.finish(exit_code, stop.reason)
+            if stop.reason:
+                app.logger.warning(f"Command '{command_name}' was stopped ({stop.reason})")
+            yield exit_record(command_name, exit_code, framed, stop.reason) + "\n"
             
         except Exception as e:
             app.logger.error(f"Error in streaming command: {str(e)}")
+            yield error_record(str(e), framed) + "\n"
+        finally:
+            # Also reached when the client goes away mid-stream: nobody reads
+            # the output any more, so don't leave the command running
+            if stop:
+                stop.disarm()
+                running_commands.discard(execution_id, stop)
             if process and process.poll() is None:
-                process.kill()
-            error_msg = f"[ERROR] Exception during execution: {str(e)}"
-            yield error_msg + "\n"
+                app.logger.warning(f"Stopping '{command_name}': its output is no longer being read")
+                signal_group(process, signal.SIGKILL)
+                process.wait()
+            # Unblock readers still waiting for room in the queue
+            while output_queue is not None and any(reader.is_alive() for reader in readers):
+                try:
+                    output_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            if run:
+                run.finish(process.returncode if process else None)
     
     return Response(
         stream_with_context(generate()),
-        mimetype='text/plain'
+        mimetype=NDJSON_MIMETYPE if framed else 'text/plain'
     )
 
 if __name__ == '__main__':
+    if AGENT_MODE == "async":
+        # Same API, served by the asyncio streaming engine
+        from async_agent import main
+        main()
+        raise SystemExit(0)
+
+    agent_metrics.track_admission(admission)
     app.logger.info(f"Starting Hermes Agent on port {AGENT_PORT}...")
     app.logger.info(f"Predefined commands directory: {PREDEFINED_COMMANDS_DIR}")
-    # Check if predefined commands dir exists and list files
+    # Check if predefined commands dir exists and index the scripts
     if os.path.exists(PREDEFINED_COMMANDS_DIR):
-        app.logger.info(f"Available scripts: {os.listdir(PREDEFINED_COMMANDS_DIR)}")
+        catalog.refresh(force=True)
+        app.logger.info(f"Available scripts: {sorted(catalog.commands)}")
     else:
         app.logger.error(f"Predefined commands directory {PREDEFINED_COMMANDS_DIR} not found!")
 
@@ -0,0 +1,104 @@
+# agent/agent_metrics.py
+"""
+Prometheus metrics of the agent, served on /metrics by both engines.
+
+Kept in their own module so they are registered once even when agent.py is
+both the entry point and imported by async_agent.py. Metrics are labelled by
+command; the host is the scrape target.
+"""
+import time
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+COMMANDS_RUNNING = Gauge('hermes_agent_commands_running', 'Command processes currently running', ['command'])
+COMMANDS_FINISHED = Counter(
+    'hermes_agent_commands_finished_total',
+    'Commands finished, by result (success, failure, error, cancelled, timeout)',
+    ['command', 'result']
+)
+COMMAND_DURATION = Histogram(
+    'hermes_agent_command_duration_seconds', 'Time from starting a command until it exited',
+    ['command'], buckets=DURATION_BUCKETS
+)
+FIRST_OUTPUT = Histogram(
+    'hermes_agent_first_output_seconds', 'Time from starting a command until its first line of output',
+    ['command'], buckets=DURATION_BUCKETS
+)
+OUTPUT_LINES = Counter('hermes_agent_output_lines_total', 'Output lines streamed', ['command', 'stream'])
+OUTPUT_BYTES = Counter('hermes_agent_output_bytes_total', 'Output bytes streamed', ['command', 'stream'])
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+class CommandRun:
+    """Records the metrics of one command process, from start to exit."""
+
+    def __init__(self, command, clock=time.monotonic):
+        self.clock = clock
+        self.command = command
+        self.started = self.clock()
+        self.first_output = False
+        self.finished = False
+        self._lines = {}
+        self._bytes = {}
+        COMMANDS_RUNNING.labels(command).inc()
+
+    def line(self, stream, size):
+        """Count one line of `size` bytes from `stream` ("stdout" or "stderr")."""
+        if not self.first_output:
+            self.first_output = True
+            FIRST_OUTPUT.labels(self.command).observe(self.clock() - self.started)
+        lines = self._lines.get(stream)
+        if lines is None:
+            lines = self._lines[stream] = OUTPUT_LINES.labels(self.command, stream)
+            self._bytes[stream] = OUTPUT_BYTES.labels(self.command, stream)
+        lines.inc()
+        self._bytes[stream].inc(size)
+
+    def finish(self, exit_code=None, stopped=None):
+        """
+        The process exited with exit_code, or failed to run if it is None;
+        `stopped` is the reason the agent stopped it, if it did. Only the first call counts.
+        """
+        if self.finished:
+            return
+        self.finished = True
+        COMMANDS_RUNNING.labels(self.command).dec()
+        COMMAND_DURATION.labels(self.command).observe(self.clock() - self.started)
+        if stopped:
+            result = stopped
+        else:
+            result = 'error' if exit_code is None else ('success' if exit_code == 0 else 'failure')
+        COMMANDS_FINISHED.labels(self.command, result).inc()
+
+class AdmissionCollector:
+    """Exposes an admission controller's stats at scrape time."""
+
+    def __init__(self, controller):
+        self.controller = controller
+
+    def collect(self):
+        stats = self.controller.stats()
+        yield GaugeMetricFamily('hermes_agent_admission_running', 'Commands holding an execution slot',
+                                value=stats['running'])
+        yield GaugeMetricFamily('hermes_agent_admission_queued', 'Requests waiting for an execution slot',
+                                value=stats['queued'])
+        yield GaugeMetricFamily('hermes_agent_admission_max_concurrency', 'Execution slots',
+                                value=stats['max_concurrency'])
+        yield CounterMetricFamily('hermes_agent_admission_rejected', 'Requests refused with 429',
+                                  value=stats['rejected'])
+
+_admission_collector = None
+
+def track_admission(controller):
+    """Report `controller` (the engine actually serving requests) on /metrics."""
+    global _admission_collector
+    if _admission_collector is None:
+        _admission_collector = AdmissionCollector(controller)
+        REGISTRY.register(_admission_collector)
+    else:
+        _admission_collector.controller = controller
+
+def render():
+    return generate_latest()
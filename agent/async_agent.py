@@ -0,0 +1,340 @@
+# agent/async_agent.py
+"""
+Asyncio streaming engine for the Hermes agent.
+
+Serves the same /health and /execute API as agent.py, but reads command output
+from asyncio subprocess pipes and forwards every line as soon as it arrives:
+no polling loop, no sleeps and no reader threads per command. A slow client
+applies backpressure all the way to the subprocess pipes.
+
+Run it with AGENT_MODE=async python agent.py, or directly with
+python async_agent.py.
+"""
+import asyncio
+import os
+import signal
+import logging
+from aiohttp import web
+import agent_metrics
+from agent_metrics import CommandRun
+from agent import (
+    PREDEFINED_COMMANDS_DIR, AGENT_PORT, HEARTBEAT_INTERVAL, STREAM_QUEUE_SIZE,
+    AGENT_MAX_CONCURRENCY, AGENT_MAX_QUEUE, AGENT_QUEUE_TIMEOUT, AGENT_RETRY_AFTER,
+    catalog, resolve_script, build_command, busy_response_body, NDJSON_MIMETYPE,
+    wants_frames, output_record, heartbeat_record, exit_record, error_record,
+    max_runtime, signal_group, StopHandle, running_commands
+)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+logger = logging.getLogger("hermes_agent.async")
+
+class AsyncAdmissionController:
+    """
+    asyncio counterpart of agent.AdmissionController. Create it inside the
+    running event loop: before Python 3.10 its Condition binds to the loop that
+    is current when it is built.
+    """
+
+    def __init__(self, max_running, max_waiting, wait_timeout):
+        self.max_running = max_running
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.running = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        """Take a slot, waiting in the queue if needed. Returns False if refused."""
+        async with self._condition:
+            if self.running < self.max_running:
+                self.running += 1
+                return True
+            if self.waiting >= self.max_waiting:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(
+                    self._condition.wait_for(lambda: self.running < self.max_running),
+                    timeout=self.wait_timeout
+                )
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                return False
+            finally:
+                self.waiting -= 1
+            self.running += 1
+            return True
+
+    async def release(self):
+        async with self._condition:
+            self.running -= 1
+            self._condition.notify()
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "queued": self.waiting,
+            "max_concurrency": self.max_running,
+            "max_queue": self.max_waiting,
+            "rejected": self.rejected
+        }
+
+class AsyncStopHandle(StopHandle):
+    """agent.StopHandle for asyncio subprocesses; its timers run on the event loop."""
+
+    def running(self):
+        return self.process.returncode is None
+
+    def later(self, delay, callback):
+        return asyncio.get_running_loop().call_later(delay, callback)
+
+async def health_check(request):
+    """Health check endpoint for the agent, including how busy it is."""
+    return web.json_response({
+        "status": "healthy",
+        "message": f"Agent on {os.uname()[1]} is up.",
+        "admission": request.app['admission'].stats()
+    })
+
+async def metrics(request):
+    """Prometheus metrics: running commands, durations, output rates and admission."""
+    return web.Response(body=agent_metrics.render(), headers={'Content-Type': agent_metrics.CONTENT_TYPE})
+
+async def cancel_command(request):
+    """Stops the command running for an execution (see agent.cancel_command)."""
+    execution_id = request.match_info['execution_id']
+    if not running_commands.stop(execution_id, "cancelled"):
+        return web.json_response({"error": f"No command is running for execution {execution_id}"}, status=404)
+    logger.info(f"Cancelling the command of execution {execution_id}")
+    return web.json_response({"execution_id": execution_id, "status": "cancelling"}, status=202)
+
+async def list_commands(request):
+    """The predefined commands this agent can run, with size, mtime and content hash."""
+    return web.json_response(catalog.describe())
+
+async def execute_command(request):
+    """
+    Executes a predefined command.
+    Expects JSON: {"command_name": "script_name.sh", "params": ["param1", "param2"]}
+    """
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not data or 'command_name' not in data:
+        return web.json_response({"error": "Missing 'command_name' in request"}, status=400)
+
+    command_name = data['command_name']
+    params = data.get('params', []) # Optional parameters for the script
+    stream_output = data.get('stream_output', False) # Whether to stream real-time output
+    execution_id = data.get('execution_id') # Lets /cancel find the command
+
+    script_path, error, status = resolve_script(command_name)
+    if error:
+        return web.json_response({"error": error}, status=status)
+
+    full_command = build_command(command_name, script_path, params)
+
+    # Wait for a free slot, or tell the caller to come back later
+    admission = request.app['admission']
+    if not await admission.acquire():
+        logger.warning(f"Refusing '{command_name}': {admission.stats()}")
+        return web.json_response(
+            busy_response_body(), status=429, headers={'Retry-After': str(AGENT_RETRY_AFTER)}
+        )
+
+    logger.info(f"Executing command: {' '.join(full_command)}")
+    try:
+        # For all shell scripts or when explicitly requested, use streaming
+        if command_name.endswith(".sh") or stream_output:
+            framed = wants_frames(request.headers.get('Accept'))
+            return await stream_command_output(request, full_command, command_name, framed, execution_id)
+        return await run_command(full_command, command_name, execution_id)
+    finally:
+        await admission.release()
+
+async def run_command(command, command_name, execution_id=None):
+    """Run a non-streaming command and return its output as JSON."""
+    try:
+        # Own process group, so stopping the command stops its children too
+        process = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=True
+        )
+    except FileNotFoundError:
+        logger.error(f"Script for {command_name} not found during exec.")
+        return web.json_response({"error": f"Script {command_name} not found. Check agent logs."}, status=500)
+
+    run = CommandRun(command_name)
+    stop = AsyncStopHandle(process)
+    stop.arm(max_runtime(command_name))
+    running_commands.add(execution_id, stop)
+    try:
+        stdout, stderr = await process.communicate()
+    finally:
+        stop.disarm()
+        running_commands.discard(execution_id, stop)
+        if process.returncode is None:
+            signal_group(process, signal.SIGKILL)
+        run.finish(process.returncode, stop.reason)
+
+    result = {
+        "command": command_name,
+        "stdout": stdout.decode(errors='replace'),
+        "stderr": stderr.decode(errors='replace'),
+        "exit_code": process.returncode
+    }
+    if stop.reason:
+        result["stopped"] = stop.reason
+    if stop.reason == "timeout":
+        logger.error(f"Command '{command_name}' timed out.")
+        return web.json_response({"error": "Command timed out", **result}, status=504)
+
+    logger.info(f"Command '{command_name}' completed with exit code {process.returncode}")
+    return web.json_response(result)
+
+async def read_line(stream):
+    """
+    The next line of `stream`, b'' at the end. A line longer than the reader's
+    limit (64 KiB) comes back in pieces of about that size instead of raising.
+    """
+    try:
+        return await stream.readuntil(b'\n')
+    except asyncio.IncompleteReadError as e:
+        # Last line without a newline, or nothing left
+        return e.partial
+    except asyncio.LimitOverrunError as e:
+        # The oversized data is still buffered; take what has been scanned so far
+        return await stream.read(max(e.consumed, 1))
+
+async def pump(stream, stream_name, lines, framed, run):
+    """Forward each line of a subprocess pipe to the client queue as it is read."""
+    split = False  # the previous piece was part of an oversized line
+    try:
+        while True:
+            line = await read_line(stream)
+            if not line:
+                break
+            if split and line == b'\n':
+                # Just the end of the oversized line that was already sent
+                split = False
+                continue
+            split = not line.endswith(b'\n')
+            run.line(stream_name.lower(), len(line))
+            await lines.put(output_record(stream_name, line.decode(errors='replace').rstrip(), framed))
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Error reading {stream_name} of the command: {e}")
+    # Tell the consumer this stream is finished, even if reading it failed
+    await lines.put(None)
+
+async def stream_command_output(request, command, command_name, framed=False, execution_id=None):
+    """
+    Stream command output line by line, as NDJSON records when framed. The
+    command can be cancelled and times out like in agent.stream_command_output.
+    """
+    content_type = NDJSON_MIMETYPE if framed else 'text/plain; charset=utf-8'
+    response = web.StreamResponse(headers={'Content-Type': content_type})
+    await response.prepare(request)
+
+    env = os.environ.copy()
+    env['PYTHONUNBUFFERED'] = '1'
+    process = None
+    run = None
+    stop = None
+    pumps = []
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, env=env,
+            start_new_session=True  # Own process group, so stopping it stops its children too
+        )
+        run = CommandRun(command_name)
+        stop = AsyncStopHandle(process)
+        stop.arm(max_runtime(command_name))
+        running_commands.add(execution_id, stop)
+        lines = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        pumps = [
+            asyncio.ensure_future(pump(process.stdout, "STDOUT", lines, framed, run)),
+            asyncio.ensure_future(pump(process.stderr, "STDERR", lines, framed, run)),
+        ]
+
+        open_streams = len(pumps)
+        while open_streams:
+            try:
+                line = await asyncio.wait_for(lines.get(), timeout=HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                # Keep the connection alive while the command is silent
+                await response.write(heartbeat_record(framed).encode() + b"\n")
+                continue
+            # Send whatever else is already waiting along with this line
+            batch = []
+            while True:
+                if line is None:
+                    open_streams -= 1
+                else:
+                    batch.append(line)
+                if lines.empty():
+                    break
+                line = lines.get_nowait()
+            if batch:
+                await response.write(("\n".join(batch) + "\n").encode())
+
+        exit_code = await process.wait()
+        run.finish(exit_code, stop.reason)
+        if stop.reason:
+            logger.warning(f"Command '{command_name}' was stopped ({stop.reason})")
+        final_status = exit_record(command_name, exit_code, framed, stop.reason)
+        await response.write(final_status.encode() + b"\n")
+    except (ConnectionResetError, asyncio.CancelledError):
+        # The client went away; don't leave the command running
+        logger.warning(f"Client disconnected while streaming '{command_name}'")
+        raise
+    except Exception as e:
+        logger.error(f"Error in streaming command: {str(e)}")
+        await response.write(error_record(str(e), framed).encode() + b"\n")
+    finally:
+        for task in pumps:
+            task.cancel()
+        if stop:
+            stop.disarm()
+            running_commands.discard(execution_id, stop)
+        if process and process.returncode is None:
+            signal_group(process, signal.SIGKILL)
+            await process.wait()
+        if run:
+            run.finish(None)
+
+    await response.write_eof()
+    return response
+
+async def start_admission(app):
+    """Build the admission controller on the loop that serves the requests."""
+    app['admission'] = AsyncAdmissionController(AGENT_MAX_CONCURRENCY, AGENT_MAX_QUEUE, AGENT_QUEUE_TIMEOUT)
+    agent_metrics.track_admission(app['admission'])
+
+def create_app():
+    app = web.Application()
+    app.on_startup.append(start_admission)
+    app.router.add_get('/health', health_check)
+    app.router.add_get('/metrics', metrics)
+    app.router.add_get('/commands', list_commands)
+    app.router.add_post('/execute', execute_command)
+    app.router.add_post('/cancel/{execution_id}', cancel_command)
+    return app
+
+def main():
+    logger.info(f"Starting Hermes Agent (asyncio engine) on port {AGENT_PORT}...")
+    logger.info(f"Predefined commands directory: {PREDEFINED_COMMANDS_DIR}")
+    if os.path.exists(PREDEFINED_COMMANDS_DIR):
+        catalog.refresh(force=True)
+        logger.info(f"Available scripts: {sorted(catalog.commands)}")
+    else:
+        logger.error(f"Predefined commands directory {PREDEFINED_COMMANDS_DIR} not found!")
+
+    # Make sure 0.0.0.0 is used to be accessible from other Docker containers
+    web.run_app(create_app(), host='0.0.0.0', port=AGENT_PORT, print=None)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+Benchmark for the agent's streaming path.
+
+Starts an agent (threaded Flask or the asyncio engine) on a free local port
+with a generated command that prints a fixed number of lines, runs many
+copies of it at once through /execute, and reports time-to-first-byte,
+line and byte throughput, and the agent process's peak RSS and CPU time.
+A fresh agent is started for every concurrency level, so the peak RSS of
+one level isn't carried into the next. With a large --lines the peak RSS
+shows whether the agent's memory grows with the size of the output.
+
+Usage (from the repository root, with agent/requirements.txt installed):
+
+    python benchmarks/bench_agent_streaming.py --mode async --concurrency 100
+    python benchmarks/bench_agent_streaming.py --mode threaded --concurrency 1 10 100 --lines 200000
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import requests
+
+AGENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'agent')
+
+# Prints $1 lines of $2 bytes each, one write per line like a chatty script
+BENCH_SCRIPT = """#!/bin/sh
+PAD=$(printf "%${2:-80}s" "" | tr " " "x")
+i=0
+while [ $i -lt ${1:-1000} ]; do
+    echo "line $i $PAD"
+    i=$((i+1))
+done
+"""
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def process_stats(pid):
+    """Peak RSS (KB) and CPU seconds used so far by a process, from /proc (Linux)."""
+    peak_rss_kb = None
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                peak_rss_kb = int(line.split()[1])
+    with open(f"/proc/{pid}/stat") as f:
+        # utime and stime are the 14th and 15th fields, after the parenthesised command name
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu_s = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    return peak_rss_kb, cpu_s
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+def start_agent(mode, commands_dir, port):
+    """Start an agent process and wait until /health answers."""
+    env = dict(os.environ, AGENT_PORT=str(port), AGENT_MODE=mode, PREDEFINED_COMMANDS_DIR=commands_dir)
+    process = subprocess.Popen(
+        [sys.executable, 'agent.py'], cwd=AGENT_DIR, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/health", timeout=1).status_code == 200:
+                return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"Agent ({mode}) did not start on port {port}")
+
+def run_stream(port, lines, line_size, framed, results):
+    """Run the benchmark command once and record its timings."""
+    started = time.monotonic()
+    first_byte = None
+    received = 0
+    received_bytes = 0
+    with requests.post(
+        f"http://127.0.0.1:{port}/execute",
+        json={'command_name': 'bench_stream.sh', 'params': [str(lines), str(line_size)]},
+        headers={'Accept': 'application/x-ndjson'} if framed else None,
+        stream=True, timeout=(5, 120)
+    ) as response:
+        for line in response.iter_lines():
+            if not line.strip() or line.startswith(b'{"t":"hb"'):
+                continue  # heartbeat
+            if first_byte is None:
+                first_byte = time.monotonic() - started
+            received += 1
+            received_bytes += len(line) + 1
+    results.append({
+        'ttfb': first_byte,
+        'elapsed': time.monotonic() - started,
+        'lines': received,
+        'bytes': received_bytes,
+    })
+
+def run(args, concurrency, commands_dir):
+    port = free_port()
+    agent = start_agent(args.mode, commands_dir, port)
+    try:
+        idle_rss_kb, cpu_before = process_stats(agent.pid)
+        results = []
+        threads = [
+            threading.Thread(target=run_stream, args=(port, args.lines, args.line_size, args.framed, results))
+            for _ in range(concurrency)
+        ]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+        peak_rss_kb, cpu_after = process_stats(agent.pid)
+    finally:
+        agent.terminate()
+        agent.wait(timeout=10)
+
+    ttfbs = [r['ttfb'] for r in results if r['ttfb'] is not None]
+    total_lines = sum(r['lines'] for r in results)
+    total_bytes = sum(r['bytes'] for r in results)
+    cpu_s = cpu_after - cpu_before
+    return {
+        'mode': args.mode,
+        'concurrency': concurrency,
+        'lines_per_stream': args.lines,
+        'line_size': args.line_size,
+        'framed': args.framed,
+        'completed_streams': len(results),
+        'elapsed_s': round(elapsed, 3),
+        'ttfb_p50_ms': round(percentile(ttfbs, 50) * 1000, 2) if ttfbs else None,
+        'ttfb_p99_ms': round(percentile(ttfbs, 99) * 1000, 2) if ttfbs else None,
+        'lines_per_s': round(total_lines / elapsed, 1),
+        'mb_per_s': round(total_bytes / elapsed / 1e6, 2),
+        'lines_per_s_per_stream_p50': round(percentile([r['lines'] / r['elapsed'] for r in results], 50), 1),
+        'agent_idle_rss_kb': idle_rss_kb,
+        'agent_peak_rss_kb': peak_rss_kb,
+        'agent_cpu_s': round(cpu_s, 3),
+        'agent_cpu_s_per_stream': round(cpu_s / concurrency, 4),
+        'agent_cpu_us_per_line': round(cpu_s / total_lines * 1e6, 2) if total_lines else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['threaded', 'async'], default='async')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 100],
+                        help='scripts running at once; one run per value (default: 1 10 100)')
+    parser.add_argument('--lines', type=int, default=1000, help='lines printed per script (default: 1000)')
+    parser.add_argument('--line-size', type=int, default=80, help='bytes per line (default: 80)')
+    parser.add_argument('--framed', action='store_true', help='ask for NDJSON records, as workers do')
+    parser.add_argument('--json', metavar='PATH', help='also write the result to this file as JSON')
+    args = parser.parse_args()
+
+    commands_dir = tempfile.mkdtemp(prefix='hermes_bench_commands_')
+    script_path = os.path.join(commands_dir, 'bench_stream.sh')
+    with open(script_path, 'w') as f:
+        f.write(BENCH_SCRIPT)
+    os.chmod(script_path, 0o755)
+
+    results = []
+    for concurrency in args.concurrency:
+        result = run(args, concurrency, commands_dir)
+        print(json.dumps(result), flush=True)
+        results.append(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+Benchmark for streamed output persistence.
+
+Simulates several executions streaming output into one SQLite file at the same
+time and compares committing every line (the old behaviour) with the batched
+OutputBuffer. Reports commits/sec and the lag between a line arriving at the
+worker and it being committed.
+
+Usage (from the repository root, with web_api/requirements.txt installed):
+
+    python benchmarks/bench_output_batching.py --executions 25 --lines 2000 --rate 500
+    python benchmarks/bench_output_batching.py --json results.json
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web_api'))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from extensions import db
+from models import CommandExecution
+from output_store import OutputBuffer, OUTPUT_FLUSH_INTERVAL_MS, OUTPUT_FLUSH_MAX_BYTES
+from storage import engine_options
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+def stream_execution(session_factory, execution_id, lines, rate, line_size, flush_interval_ms, flush_max_bytes, lags):
+    """Feed one execution's output into an OutputBuffer at a fixed line rate."""
+    session = session_factory()
+    buffer = OutputBuffer(session, execution_id, flush_interval_ms=flush_interval_ms, flush_max_bytes=flush_max_bytes)
+    payload = 'x' * line_size
+    interval = 1.0 / rate if rate else 0
+    waiting = []  # arrival times of lines that are not committed yet
+    next_at = time.monotonic()
+    for i in range(lines):
+        if interval:
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_at += interval
+        waiting.append(time.monotonic())
+        buffer.append(f"[00:00:00] [STDOUT] {i} {payload}")
+        if buffer.pending_bytes == 0:
+            committed_at = time.monotonic()
+            lags.extend(committed_at - arrived for arrived in waiting)
+            waiting = []
+    buffer.flush()
+    committed_at = time.monotonic()
+    lags.extend(committed_at - arrived for arrived in waiting)
+    session.close()
+    return buffer.commits
+
+def run_scenario(name, args, flush_interval_ms, flush_max_bytes):
+    db_path = os.path.join(tempfile.mkdtemp(prefix='hermes_bench_'), 'bench.db')
+    # Same connection settings (WAL, busy timeout, pool) as the web app and workers
+    url = f"sqlite:///{db_path}"
+    engine = create_engine(url, **engine_options(url))
+    db.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+
+    session = session_factory()
+    executions = [CommandExecution(command_name='bench.sh', target_host='bench', user='bench')
+                  for _ in range(args.executions)]
+    session.add_all(executions)
+    session.commit()
+    execution_ids = [execution.id for execution in executions]
+    session.close()
+
+    lags = []
+    commits = []
+    lock = threading.Lock()
+
+    def worker(execution_id):
+        local_lags = []
+        count = stream_execution(session_factory, execution_id, args.lines, args.rate, args.line_size,
+                                 flush_interval_ms, flush_max_bytes, local_lags)
+        with lock:
+            lags.extend(local_lags)
+            commits.append(count)
+
+    threads = [threading.Thread(target=worker, args=(execution_id,)) for execution_id in execution_ids]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    engine.dispose()
+
+    total_commits = sum(commits)
+    total_lines = args.executions * args.lines
+    return {
+        'scenario': name,
+        'flush_interval_ms': flush_interval_ms,
+        'flush_max_bytes': flush_max_bytes,
+        'executions': args.executions,
+        'lines': total_lines,
+        'elapsed_s': round(elapsed, 3),
+        'commits': total_commits,
+        'commits_per_s': round(total_commits / elapsed, 1),
+        'lines_per_s': round(total_lines / elapsed, 1),
+        'lag_p50_ms': round(percentile(lags, 50) * 1000, 2),
+        'lag_p99_ms': round(percentile(lags, 99) * 1000, 2),
+        'lag_max_ms': round(max(lags) * 1000, 2),
+        'db_bytes': os.path.getsize(db_path),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--executions', type=int, default=25, help='concurrent executions (default: 25)')
+    parser.add_argument('--lines', type=int, default=1000, help='lines per execution (default: 1000)')
+    parser.add_argument('--rate', type=float, default=200, help='lines/sec per execution, 0 for unthrottled (default: 200)')
+    parser.add_argument('--line-size', type=int, default=80, help='payload bytes per line (default: 80)')
+    parser.add_argument('--flush-interval-ms', type=int, default=OUTPUT_FLUSH_INTERVAL_MS)
+    parser.add_argument('--flush-max-bytes', type=int, default=OUTPUT_FLUSH_MAX_BYTES)
+    parser.add_argument('--json', metavar='PATH', help='also write the results to this file as JSON')
+    args = parser.parse_args()
+
+    results = [
+        run_scenario('per_line', args, flush_interval_ms=0, flush_max_bytes=0),
+        run_scenario('batched', args, flush_interval_ms=args.flush_interval_ms, flush_max_bytes=args.flush_max_bytes),
+    ]
+    for result in results:
+        print(json.dumps(result))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+Stand-in agent for load benchmarks (standard library only).
+
+Speaks the same /health, /commands and /execute API as agent/agent.py,
+including the framed NDJSON protocol, but instead of running scripts it
+generates output at a configurable rate and size. Every line carries its
+sequence number and the epoch time it was emitted ("seq=12 t=1718000000.123456
+xxxx..."), so a benchmark can tell how long a line took to become visible.
+
+One fake agent can stand in for many hosts: requests under /hosts/<name>/
+are answered as if they were sent to the agent on <name>. Point the workers
+at it with
+
+    AGENT_URL_TEMPLATE=http://127.0.0.1:<port>/hosts/{host}
+
+The output of one /execute call is controlled by its params, each optional:
+[lines, line_size, lines_per_second (0 = unthrottled), exit_code]. Missing
+values fall back to the command-line defaults.
+
+Usage:
+
+    python benchmarks/fake_agent.py --port 9900 --lines 1000 --rate 200
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+DEFAULT_COMMANDS = ('bench_short.sh', 'bench_chatty.sh', 'bench_fanout.sh')
+
+# Output is written in chunks of at most this many bytes, or after this long
+WRITE_CHUNK_BYTES = 64 * 1024
+WRITE_INTERVAL = 0.05  # seconds
+
+def frame(record):
+    return json.dumps(record, separators=(',', ':')) + '\n'
+
+def legacy_line(stream, text, ts):
+    return f"[{time.strftime('%H:%M:%S', time.localtime(ts))}] [{stream.upper()}] {text}\n"
+
+class FakeAgentHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'HermesFakeAgent/1.0'
+
+    def log_message(self, format, *args):
+        pass  # one line per request would dominate a benchmark's output
+
+    def split_host(self):
+        """Return (host, path) for /hosts/<host>/<path>, or (None, path)."""
+        path = self.path.split('?', 1)[0]
+        if path.startswith('/hosts/'):
+            host, _, rest = path[len('/hosts/'):].partition('/')
+            return host, '/' + rest
+        return None, path
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        host, path = self.split_host()
+        if path == '/health':
+            self.send_json(200, {'status': 'healthy', 'host': host})
+        elif path == '/commands':
+            self.send_json(200, {
+                'host': host,
+                'version': 'fake',
+                'commands': [{'name': name} for name in self.server.commands]
+            })
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        host, path = self.split_host()
+        length = int(self.headers.get('Content-Length') or 0)
+        data = json.loads(self.rfile.read(length) or b'{}')
+        if path != '/execute':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        if not data.get('command_name'):
+            self.send_json(400, {'error': "Missing 'command_name' in request"})
+            return
+        self.server.count_request(host)
+        self.stream(data['command_name'], data.get('params') or [])
+
+    def write_chunk(self, text):
+        body = text.encode()
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(body), body))
+
+    def stream(self, command_name, params):
+        defaults = self.server.defaults
+        values = [int(float(value)) for value in params[:4]]
+        lines, line_size, rate, exit_code = values + defaults[len(values):]
+        framed = NDJSON_MIMETYPE in self.headers.get('Accept', '')
+
+        self.send_response(200)
+        self.send_header('Content-Type', NDJSON_MIMETYPE if framed else 'text/plain')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        pad = 'x' * line_size
+        interval = 1.0 / rate if rate else 0
+        next_at = last_write = time.monotonic()
+        pending = []
+        pending_bytes = 0
+        try:
+            for seq in range(lines):
+                if interval:
+                    delay = next_at - time.monotonic()
+                    if delay > 0:
+                        # Don't hold back finished lines while sleeping
+                        if pending:
+                            self.write_chunk(''.join(pending))
+                            pending, pending_bytes, last_write = [], 0, time.monotonic()
+                        time.sleep(delay)
+                    next_at += interval
+                ts = time.time()
+                text = f"seq={seq} t={ts:.6f} {pad}"
+                record = frame({'t': 'out', 's': 'stdout', 'ts': round(ts, 3), 'd': text}) if framed \
+                    else legacy_line('STDOUT', text, ts)
+                pending.append(record)
+                pending_bytes += len(record)
+                if pending_bytes >= WRITE_CHUNK_BYTES or time.monotonic() - last_write >= WRITE_INTERVAL:
+                    self.write_chunk(''.join(pending))
+                    pending, pending_bytes, last_write = [], 0, time.monotonic()
+
+            ts = time.time()
+            if framed:
+                pending.append(frame({'t': 'exit', 'code': exit_code, 'ts': round(ts, 3)}))
+            else:
+                pending.append(legacy_line(
+                    'INFO', f"Command '{command_name}' completed with exit code {exit_code}", ts
+                ))
+            self.write_chunk(''.join(pending))
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the worker gave up on the stream
+        finally:
+            self.server.count_finished(lines)
+
+class FakeAgentServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, commands=DEFAULT_COMMANDS, lines=100, line_size=80, rate=0, exit_code=0):
+        super().__init__(address, FakeAgentHandler)
+        self.commands = list(commands)
+        self.defaults = [lines, line_size, rate, exit_code]
+        self.lock = threading.Lock()
+        self.requests_by_host = {}
+        self.finished = 0
+        self.lines_sent = 0
+
+    def count_request(self, host):
+        with self.lock:
+            self.requests_by_host[host] = self.requests_by_host.get(host, 0) + 1
+
+    def count_finished(self, lines):
+        with self.lock:
+            self.finished += 1
+            self.lines_sent += lines
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': sum(self.requests_by_host.values()),
+                'hosts': len(self.requests_by_host),
+                'finished': self.finished,
+                'lines_sent': self.lines_sent
+            }
+
+def start_in_thread(port=0, **options):
+    """Start a fake agent on 127.0.0.1 in a background thread. Returns the server."""
+    server = FakeAgentServer(('127.0.0.1', port), **options)
+    threading.Thread(target=server.serve_forever, name='fake-agent', daemon=True).start()
+    return server
+
+def url_template(server):
+    """AGENT_URL_TEMPLATE that sends every host to `server`."""
+    return f"http://127.0.0.1:{server.server_address[1]}/hosts/{{host}}"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=9900)
+    parser.add_argument('--bind', default='127.0.0.1')
+    parser.add_argument('--lines', type=int, default=100, help='default lines per execution (default: 100)')
+    parser.add_argument('--line-size', type=int, default=80, help='default payload bytes per line (default: 80)')
+    parser.add_argument('--rate', type=int, default=0, help='default lines/sec per execution, 0 for unthrottled')
+    parser.add_argument('--exit-code', type=int, default=0)
+    parser.add_argument('--commands', nargs='*', default=list(DEFAULT_COMMANDS),
+                        help='command names listed on /commands')
+    args = parser.parse_args()
+
+    server = FakeAgentServer(
+        (args.bind, args.port), commands=args.commands,
+        lines=args.lines, line_size=args.line_size, rate=args.rate, exit_code=args.exit_code
+    )
+    print(f"Fake agent listening on {args.bind}:{server.server_address[1]} "
+          f"(AGENT_URL_TEMPLATE=http://{args.bind}:{server.server_address[1]}/hosts/{{host}})", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# web_api/agent_client.py
+"""
+Pooled HTTP client for talking to the agents on target hosts.
+
+Each process keeps one requests.Session per host, so consecutive calls to the
+same agent reuse keep-alive connections instead of opening a new TCP
+connection every time. Every call gets a connect timeout and a read timeout;
+while streaming, the read timeout bounds how long the agent may stay silent.
+"""
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+# Base URL of an agent; {host} is replaced with the target host name
+AGENT_URL_TEMPLATE = os.getenv('AGENT_URL_TEMPLATE', 'http://{host}:9000')
+
+# Seconds to wait for a TCP connection to an agent
+AGENT_CONNECT_TIMEOUT = float(os.getenv('AGENT_CONNECT_TIMEOUT', '5'))
+# Seconds an agent may go without sending anything (agents send a heartbeat every 10s)
+AGENT_READ_TIMEOUT = float(os.getenv('AGENT_READ_TIMEOUT', '60'))
+
+# Idle connections kept per host. Extra concurrent requests still get a
+# connection unless AGENT_POOL_BLOCK is set, but it is closed after use.
+AGENT_POOL_MAXSIZE = int(os.getenv('AGENT_POOL_MAXSIZE', '10'))
+AGENT_POOL_BLOCK = os.getenv('AGENT_POOL_BLOCK', 'false').lower() == 'true'
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def agent_url(host, path=''):
+    """Return the URL of `path` on the agent running on `host`."""
+    return AGENT_URL_TEMPLATE.format(host=host).rstrip('/') + path
+
+def get_agent_session(host):
+    """Return the pooled session for `host`, creating it on first use."""
+    session = _sessions.get(host)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=AGENT_POOL_MAXSIZE,
+                    pool_block=AGENT_POOL_BLOCK,
+                    max_retries=0
+                )
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _sessions[host] = session
+    return session
+
+def request(method, host, path, **kwargs):
+    """Send a request to an agent with the configured timeouts."""
+    kwargs.setdefault('timeout', (AGENT_CONNECT_TIMEOUT, AGENT_READ_TIMEOUT))
+    return get_agent_session(host).request(method, agent_url(host, path), **kwargs)
+
+def post(host, path, **kwargs):
+    return request('POST', host, path, **kwargs)
+
+def get(host, path, **kwargs):
+    return request('GET', host, path, **kwargs)
+
+def pool_stats():
+    """
+    Connection reuse per host: requests sent, connections opened, how many
+    requests reused an existing connection, and idle connections in the pool.
+    """
+    stats = {}
+    for host, session in list(_sessions.items()):
+        adapter = session.get_adapter(agent_url(host))
+        pools = adapter.poolmanager.pools
+        requests_sent = connections_opened = idle = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_sent += pool.num_requests
+            connections_opened += pool.num_connections
+            # The pool queue is padded with None placeholders for connections not yet opened
+            idle += sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0
+        stats[host] = {
+            'requests': requests_sent,
+            'connections_opened': connections_opened,
+            'reused': max(0, requests_sent - connections_opened),
+            'idle_connections': idle
+        }
+    return stats
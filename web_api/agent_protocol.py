@@ -0,0 +1,101 @@
+# web_api/agent_protocol.py
+"""
+Decoding the output stream of an agent's /execute call.
+
+Workers ask for the framed protocol (Accept: application/x-ndjson): one JSON
+record per line carrying output, heartbeats, errors and the exit code. Agents
+that predate it answer with plain "[HH:MM:SS] [STDOUT] ..." lines, which are
+decoded into the same events.
+"""
+import json
+import time
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# Sent with /execute so agents that support it answer with frames
+REQUEST_HEADERS = {'Accept': f'{NDJSON_MIMETYPE}, text/plain;q=0.5'}
+
+class StreamEvent:
+    """
+    One decoded record: kind is 'output', 'heartbeat', 'exit' or 'error'.
+    An exit has a reason ('cancelled' or 'timeout') if the agent stopped the command.
+    """
+    __slots__ = ('kind', 'line', 'stream', 'exit_code', 'reason')
+
+    def __init__(self, kind, line=None, stream=None, exit_code=None, reason=None):
+        self.kind = kind
+        self.line = line
+        self.stream = stream
+        self.exit_code = exit_code
+        self.reason = reason
+
+HEARTBEAT = StreamEvent('heartbeat')
+
+class _ClockFormatter:
+    """Renders epoch timestamps as HH:MM:SS, formatting each second only once."""
+
+    def __init__(self):
+        self._second = None
+        self._text = None
+
+    def __call__(self, ts):
+        second = int(ts)
+        if second != self._second:
+            self._second = second
+            self._text = time.strftime('%H:%M:%S', time.localtime(second))
+        return self._text
+
+def is_framed(response):
+    """True if the agent answered with the framed protocol."""
+    return response.headers.get('Content-Type', '').startswith(NDJSON_MIMETYPE)
+
+def decode_frames(lines, command_name):
+    """Turn NDJSON records into StreamEvents. Output lines keep the legacy layout."""
+    clock = _ClockFormatter()
+    for raw in lines:
+        if not raw:
+            continue
+        record = json.loads(raw)
+        kind = record.get('t')
+        if kind == 'out':
+            stream = record.get('s', 'stdout')
+            line = f"[{clock(record.get('ts', time.time()))}] [{stream.upper()}] {record.get('d', '')}"
+            yield StreamEvent('output', line, stream)
+        elif kind == 'hb':
+            yield HEARTBEAT
+        elif kind == 'exit':
+            code = int(record['code'])
+            reason = record.get('reason')
+            stopped = f" was stopped ({reason}) and" if reason else ""
+            line = f"[{clock(record.get('ts', time.time()))}] [INFO] Command '{command_name}'{stopped} completed with exit code {code}"
+            yield StreamEvent('exit', line, 'system', code, reason)
+        elif kind == 'err':
+            yield StreamEvent('error', f"[ERROR] Exception during execution: {record.get('d', '')}", 'system')
+        # Unknown record types are skipped so agents can add new ones
+
+def decode_legacy(lines):
+    """Turn plain text lines from an older agent into StreamEvents."""
+    completed_marker = 'completed with exit code '
+    stopped_marker = ' was stopped ('
+    for line in lines:
+        if not line or line.isspace():
+            yield HEARTBEAT
+            continue
+        stream = 'stderr' if line[11:19] == '[STDERR]' else 'stdout'
+        if line[11:17] == '[INFO]':
+            _, found, code = line.rpartition(completed_marker)
+            if found and code.lstrip('-').isdigit():
+                _, stopped, rest = line.partition(stopped_marker)
+                reason = rest.partition(')')[0] if stopped else None
+                yield StreamEvent('exit', line, 'system', int(code), reason)
+                continue
+        if line.startswith('[ERROR] '):
+            yield StreamEvent('error', line, 'system')
+            continue
+        yield StreamEvent('output', line, stream)
+
+def decode_stream(response, command_name):
+    """Decode a streaming /execute response, whichever format the agent used."""
+    if is_framed(response):
+        return decode_frames(response.iter_lines(), command_name)
+    return decode_legacy(response.iter_lines(decode_unicode=True))
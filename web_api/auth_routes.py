@@ -1,15 +1,11 @@
 # web_api/auth_routes.py
 from flask import Blueprint, request, jsonify
-from sqlalchemy.orm import scoped_session, sessionmaker
-from extensions import db
 from models import User
 from auth import generate_token, token_required, admin_required
+from storage import get_session
 
 auth = Blueprint('auth', __name__)
 
-def get_session():
-    return scoped_session(sessionmaker(bind=db.engine))
-
 @auth.route('/register', methods=['POST'])
 def register():
     """Register a new user"""
@@ -0,0 +1,127 @@
+# web_api/coalesce.py
+"""
+Single-flight execution of identical commands.
+
+When a request opts in with "coalesce": true and the same command is already
+pending or running on the same host with the same params, the new
+CommandExecution is recorded as a follower of that run (leader_id) instead of
+being dispatched. Followers read the leader's output, and the worker copies
+the leader's status onto its followers whenever it changes.
+
+A cancel only speaks for the leader's own user. When a leader is cancelled,
+its user's followers are cancelled with it, and the oldest follower of
+another user is promoted to leader of the remaining followers and dispatched.
+"""
+import json
+import time
+import logging
+from sqlalchemy import select, update
+from models import CommandExecution, FINISHED_STATUSES
+from extensions import celery_app
+
+logger = logging.getLogger(__name__)
+
+IN_FLIGHT_STATUSES = ('pending', 'running')
+
+def find_inflight_leader(session, command_name, target_host, params):
+    """Return the newest in-flight execution with the same command, host and params."""
+    return session.scalars(
+        select(CommandExecution)
+        .where(
+            CommandExecution.command_name == command_name,
+            CommandExecution.target_host == target_host,
+            CommandExecution.params == params,
+            CommandExecution.status.in_(IN_FLIGHT_STATUSES),
+            CommandExecution.leader_id.is_(None),
+            CommandExecution.cancel_requested_at.is_(None)
+        )
+        .order_by(CommandExecution.start_time.desc(), CommandExecution.id.desc())
+        .limit(1)
+    ).first()
+
+def attach_follower(session, leader, user):
+    """Record a follower execution of `leader` for `user` and commit it."""
+    follower = CommandExecution(
+        command_name=leader.command_name,
+        target_host=leader.target_host,
+        params=leader.params,
+        user=user,
+        status=leader.status,
+        leader_id=leader.id
+    )
+    session.add(follower)
+    session.commit()
+
+    # The leader may have finished after it was looked up but before the
+    # follower existed, in which case the worker didn't update the follower
+    session.refresh(leader)
+    if leader.status != follower.status:
+        copy_status(leader, follower)
+        session.commit()
+    return follower
+
+def copy_status(leader, follower):
+    follower.status = leader.status
+    if leader.status in FINISHED_STATUSES:
+        follower.end_time = leader.end_time
+        follower.exit_code = leader.exit_code
+
+def sync_followers(session, leader):
+    """
+    Stage the leader's status, end time and exit code on all of its
+    followers, except those already finished (cancelled on their own). Runs
+    in the caller's transaction.
+
+    If the leader was cancelled, returns the follower promoted to take over
+    for other users (see promote_follower), which the caller passes to
+    dispatch_promoted() once committed; otherwise None.
+    """
+    promoted = promote_follower(session, leader) if leader.status == 'cancelled' else None
+    session.execute(
+        update(CommandExecution)
+        .where(CommandExecution.leader_id == leader.id, CommandExecution.status.notin_(FINISHED_STATUSES))
+        .values(status=leader.status, end_time=leader.end_time, exit_code=leader.exit_code)
+    )
+    return promoted
+
+def promote_follower(session, leader):
+    """
+    Make the oldest unfinished follower of another user than the leader's the
+    new leader of all such followers. Returns it, or None if there is none.
+    """
+    others = (
+        CommandExecution.leader_id == leader.id,
+        CommandExecution.status.notin_(FINISHED_STATUSES),
+        CommandExecution.user != leader.user
+    )
+    promoted = session.scalars(
+        select(CommandExecution).where(*others).order_by(CommandExecution.id).limit(1)
+    ).first()
+    if promoted is None:
+        return None
+    session.execute(
+        update(CommandExecution)
+        .where(*others, CommandExecution.id != promoted.id)
+        .values(leader_id=promoted.id)
+    )
+    promoted.leader_id = None
+    promoted.status = 'pending'
+    session.flush()
+    return promoted
+
+def dispatch_promoted(execution):
+    """Queue the run of a follower promoted by sync_followers. Call after the commit."""
+    if execution is None:
+        return
+    logger.info(f"Execution {execution.id} takes over the cancelled run it was following")
+    # Sent by name: tasks.py imports this module
+    celery_app.send_task('execute_command', args=(
+        execution.id, execution.command_name, execution.target_host,
+        json.loads(execution.params) if execution.params else [], execution.user
+    ), kwargs={'submitted_at': time.time()})
+
+def output_source(session, execution):
+    """The execution whose output `execution` shows: its leader, or itself."""
+    if execution.leader_id is None:
+        return execution
+    return session.get(CommandExecution, execution.leader_id) or execution
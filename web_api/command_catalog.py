@@ -0,0 +1,88 @@
+# web_api/command_catalog.py
+"""
+Per-host cache of the command catalogs published by the agents on /commands.
+
+Each catalog is kept for COMMAND_CATALOG_TTL seconds. If an agent cannot be
+reached, the last catalog fetched from it is used; if there is none, the
+catalog is unknown and callers should not reject commands on its account.
+After a failed fetch the agent is not asked again for
+COMMAND_CATALOG_RETRY_AFTER seconds, so a host that is down doesn't add a
+timeout to every request for it.
+"""
+import os
+import time
+import threading
+import logging
+import requests
+import agent_client
+
+logger = logging.getLogger(__name__)
+
+# Seconds a fetched catalog is trusted before asking the agent again
+COMMAND_CATALOG_TTL = float(os.getenv('COMMAND_CATALOG_TTL', '60'))
+# Seconds to wait for an agent's /commands before falling back to the cached copy
+COMMAND_CATALOG_TIMEOUT = float(os.getenv('COMMAND_CATALOG_TIMEOUT', '3'))
+# Seconds to wait after a failed fetch before asking the agent again
+COMMAND_CATALOG_RETRY_AFTER = float(os.getenv('COMMAND_CATALOG_RETRY_AFTER', '30'))
+
+_catalogs = {}  # host -> (fetched_at, catalog)
+_failures = {}  # host -> when the last fetch failed
+_lock = threading.Lock()
+
+def fetch_catalog(host):
+    """Ask the agent on `host` for its catalog."""
+    response = agent_client.get(host, '/commands', timeout=(COMMAND_CATALOG_TIMEOUT, COMMAND_CATALOG_TIMEOUT))
+    response.raise_for_status()
+    return response.json()
+
+def get_catalog(host, max_age=None):
+    """Return the catalog of `host` (possibly stale), or None if it was never fetched."""
+    max_age = COMMAND_CATALOG_TTL if max_age is None else max_age
+    cached = _catalogs.get(host)
+    if cached is not None and time.monotonic() - cached[0] < max_age:
+        return cached[1]
+    failed_at = _failures.get(host)
+    if failed_at is not None and time.monotonic() - failed_at < COMMAND_CATALOG_RETRY_AFTER:
+        return cached[1] if cached is not None else None
+
+    try:
+        catalog = fetch_catalog(host)
+    except (requests.RequestException, ValueError) as e:
+        logger.warning(f"Could not fetch the command catalog of {host}: {e}")
+        with _lock:
+            _failures[host] = time.monotonic()
+        if cached is not None:
+            return cached[1]
+        return None
+
+    with _lock:
+        _catalogs[host] = (time.monotonic(), catalog)
+        _failures.pop(host, None)
+    return catalog
+
+def command_names(host):
+    """Names of the commands available on `host`, or None if unknown."""
+    catalog = get_catalog(host)
+    if catalog is None:
+        return None
+    return {command['name'] for command in catalog.get('commands', [])}
+
+def is_known_command(host, command_name):
+    """
+    True or False when the catalog of `host` says whether it has the command,
+    None when the catalog is not available.
+    """
+    names = command_names(host)
+    if names is None:
+        return None
+    return command_name in names
+
+def invalidate(host=None):
+    """Forget the cached catalog of one host, or of all hosts."""
+    with _lock:
+        if host is None:
+            _catalogs.clear()
+            _failures.clear()
+        else:
+            _catalogs.pop(host, None)
+            _failures.pop(host, None)
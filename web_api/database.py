@@ -1,6 +1,7 @@
 # web_api/database.py
 
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, text, literal
 from extensions import db
 
 def init_db(app):
@@ -8,3 +9,61 @@ def init_db(app):
     with app.app_context():
         db.create_all()
         print("[init_db] create_all() called")
+        add_missing_columns(db.engine)
+        create_missing_indexes(db.engine)
+        normalize_start_times(db.engine)
+
+def add_missing_columns(engine):
+    """
+    create_all() never alters existing tables, so add any column a model
+    declares that an existing database doesn't have yet. A NOT NULL column
+    is added only if it has a constant default to fill the existing rows with.
+    """
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                definition = f"{quote(column.name)} {column.type.compile(dialect=engine.dialect)}"
+                if not column.nullable:
+                    if column.default is None or not column.default.is_scalar:
+                        raise RuntimeError(
+                            f"Can't add the NOT NULL column {table.name}.{column.name} to an existing "
+                            f"table: it has no constant default. Migrate the table by hand."
+                        )
+                    default = literal(column.default.arg, column.type).compile(
+                        dialect=engine.dialect, compile_kwargs={'literal_binds': True}
+                    )
+                    definition += f" NOT NULL DEFAULT {default}"
+                conn.execute(text(f"ALTER TABLE {quote(table.name)} ADD COLUMN {definition}"))
+                print(f"[init_db] Added column {table.name}.{column.name}")
+
+def create_missing_indexes(engine):
+    """
+    create_all() only creates indexes together with new tables, so add any
+    index declared on a model that an existing database doesn't have yet.
+    """
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+def normalize_start_times(engine):
+    """
+    SQLite stored start_time as 'YYYY-MM-DD HH:MM:SS' while the database set
+    it; SQLAlchemy writes and compares '... HH:MM:SS.ffffff'. Give older rows
+    the fractional part so both sort and compare as the same format.
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+    with engine.begin() as conn:
+        result = conn.execute(text(
+            "UPDATE command_executions SET start_time = start_time || '.000000' "
+            "WHERE start_time IS NOT NULL AND length(start_time) = 19"
+        ))
+        if result.rowcount:
+            print(f"[init_db] Normalized start_time of {result.rowcount} executions")
@@ -0,0 +1,137 @@
+# web_api/dispatch.py
+"""
+Creating and dispatching many executions at once.
+
+Rows are inserted with a single bulk INSERT and the Celery tasks are sent as
+one group (or over one producer) instead of one commit and one delay() per
+execution.
+"""
+import os
+import json
+import time
+from celery import group, chain
+from sqlalchemy import insert
+from models import CommandExecution, ExecutionRun
+from tasks import execute_command
+from extensions import celery_app
+from result_cache import params_key
+from timings import create_timings
+from routing import queue_for
+import metrics
+
+# Named sets of target hosts, e.g. HOST_GROUPS='{"web": ["web1", "web2"]}'
+HOST_GROUPS = json.loads(os.getenv(
+    'HOST_GROUPS',
+    '{"all": ["hermes_target_alpha", "hermes_target_beta"]}'
+))
+
+# Upper bound on how many hosts of one fan-out run at the same time
+FANOUT_MAX_PARALLELISM = int(os.getenv('FANOUT_MAX_PARALLELISM', '50'))
+
+# Most executions accepted by one POST /execute_batch
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', '1000'))
+
+def resolve_hosts(target_hosts=None, host_group=None):
+    """Return the de-duplicated host list for a fan-out request."""
+    hosts = list(target_hosts or [])
+    if host_group:
+        if host_group not in HOST_GROUPS:
+            raise ValueError(f"Unknown host group: {host_group}")
+        hosts.extend(HOST_GROUPS[host_group])
+    # Keep the first occurrence of each host, in request order
+    return list(dict.fromkeys(hosts))
+
+def create_executions(session, rows):
+    """
+    Insert CommandExecution rows with one bulk INSERT and return their ids in
+    the same order as `rows`. The caller commits.
+    """
+    if not rows:
+        return []
+    return session.scalars(
+        insert(CommandExecution).returning(CommandExecution.id, sort_by_parameter_order=True),
+        [dict(row, status='pending') for row in rows]
+    ).all()
+
+def dispatch_lanes(calls, parallelism):
+    """
+    Send execute_command calls as a Celery group of at most `parallelism`
+    chains. Tasks within a chain run one after another, which caps how many
+    of them run at once. They go to the bulk queue (or their host's queue) so
+    a large fan-out doesn't hold up interactive commands.
+    """
+    parallelism = max(1, min(parallelism, len(calls)))
+    submitted_at = time.time()
+    lanes = [calls[i::parallelism] for i in range(parallelism)]
+    return group(
+        chain(*[
+            execute_command.si(*args, submitted_at=submitted_at).set(queue=queue_for(args[1], args[2], bulk=True))
+            for args in lane
+        ]) for lane in lanes
+    ).apply_async()
+
+def publish(calls):
+    """
+    Send execute_command calls to the bulk queue (or their host's queue)
+    over one broker connection, in order.
+    """
+    submitted_at = time.time()
+    with celery_app.producer_or_acquire() as producer:
+        for args in calls:
+            execute_command.apply_async(
+                args=args, kwargs={'submitted_at': submitted_at},
+                queue=queue_for(args[1], args[2], bulk=True), producer=producer
+            )
+
+def submit_batch(session, items, user):
+    """
+    Create one execution per (command_name, target_host, params) item in one
+    transaction and dispatch them. Returns the execution ids in item order.
+    """
+    execution_ids = create_executions(session, [
+        {'command_name': command_name, 'target_host': target_host, 'user': user, 'params': params_key(params)}
+        for command_name, target_host, params in items
+    ])
+    create_timings(session, execution_ids)
+    session.commit()
+
+    publish([
+        (execution_id, command_name, target_host, params, user)
+        for execution_id, (command_name, target_host, params) in zip(execution_ids, items)
+    ])
+    for command_name, target_host, _ in items:
+        metrics.EXECUTIONS_SUBMITTED.labels(command_name, target_host, 'dispatched').inc()
+    return execution_ids
+
+def fan_out(session, command_name, hosts, params, user, parallelism=None, host_group=None):
+    """
+    Create an ExecutionRun with one execution per host and dispatch them.
+    Returns (run, execution_ids).
+    """
+    parallelism = min(parallelism or FANOUT_MAX_PARALLELISM, FANOUT_MAX_PARALLELISM)
+
+    run = ExecutionRun(
+        command_name=command_name,
+        user=user,
+        host_group=host_group,
+        host_count=len(hosts),
+        parallelism=parallelism
+    )
+    session.add(run)
+    session.flush()
+
+    execution_ids = create_executions(session, [
+        {'command_name': command_name, 'target_host': host, 'user': user, 'run_id': run.id,
+         'params': params_key(params)}
+        for host in hosts
+    ])
+    create_timings(session, execution_ids)
+    session.commit()
+
+    dispatch_lanes([
+        (execution_id, command_name, host, params, user)
+        for execution_id, host in zip(execution_ids, hosts)
+    ], parallelism)
+    for host in hosts:
+        metrics.EXECUTIONS_SUBMITTED.labels(command_name, host, 'dispatched').inc()
+    return run, execution_ids
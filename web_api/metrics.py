@@ -0,0 +1,111 @@
+# web_api/metrics.py
+"""
+Prometheus metrics for the web app and the workers.
+
+The web app serves them on /metrics. Each worker serves its own on a small
+HTTP listener (WORKER_METRICS_PORT, see start_worker.py). Per-execution
+metrics are labelled by command and host.
+"""
+import os
+import time
+from contextlib import contextmanager
+from prometheus_client import Counter, Histogram, start_http_server, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Port of the worker's metrics listener; 0 disables it
+WORKER_METRICS_PORT = int(os.getenv('WORKER_METRICS_PORT', '9101'))
+
+LABELS = ('command', 'host')
+
+# Seconds, from milliseconds up to the length of a long-running command
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+EXECUTIONS_SUBMITTED = Counter(
+    'hermes_executions_submitted_total',
+    'Executions requested, by how they were answered (dispatched, cached, coalesced, scheduled, skipped_in_flight)',
+    LABELS + ('outcome',)
+)
+EXECUTIONS_FINISHED = Counter(
+    'hermes_executions_finished_total', 'Executions finished by a worker, by final status', LABELS + ('status',)
+)
+QUEUE_WAIT = Histogram(
+    'hermes_queue_wait_seconds', 'Time from submission until a worker picked the execution up',
+    LABELS, buckets=LATENCY_BUCKETS
+)
+AGENT_FIRST_BYTE = Histogram(
+    'hermes_agent_first_byte_seconds', 'Time from calling the agent until its first record arrived',
+    LABELS, buckets=LATENCY_BUCKETS
+)
+EXECUTION_DURATION = Histogram(
+    'hermes_execution_duration_seconds', 'Time from calling the agent until the execution was recorded as finished',
+    LABELS, buckets=LATENCY_BUCKETS
+)
+OUTPUT_LINES = Counter('hermes_output_lines_total', 'Output lines received from agents', LABELS)
+OUTPUT_BYTES = Counter('hermes_output_bytes_total', 'Output bytes received from agents', LABELS)
+OUTPUT_LINE_RATE = Histogram(
+    'hermes_execution_output_lines_per_second', 'Average output lines/sec of each finished execution',
+    LABELS, buckets=(1, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000)
+)
+OUTPUT_BYTE_RATE = Histogram(
+    'hermes_execution_output_bytes_per_second', 'Average output bytes/sec of each finished execution',
+    LABELS, buckets=(100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+)
+DB_COMMIT = Histogram(
+    'hermes_db_commit_seconds', 'Latency of database commits made while running an execution',
+    LABELS + ('kind',), buckets=LATENCY_BUCKETS
+)
+REALTIME_PUBLISH = Histogram(
+    'hermes_realtime_publish_seconds', 'Latency of publishing a realtime event to the message queue',
+    ('event',), buckets=LATENCY_BUCKETS
+)
+REALTIME_PUBLISH_FAILURES = Counter(
+    'hermes_realtime_publish_failures_total', 'Realtime events that could not be published', ('event',)
+)
+
+@contextmanager
+def timed_commit(command, host, kind):
+    """Observe how long the commit inside the block takes."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        DB_COMMIT.labels(command, host, kind).observe(time.perf_counter() - started)
+
+def observe_publish(event, seconds, sent):
+    """Record one realtime publish (see realtime.EventSender)."""
+    REALTIME_PUBLISH.labels(event).observe(seconds)
+    if not sent:
+        REALTIME_PUBLISH_FAILURES.labels(event).inc()
+
+class RealtimeSenderCollector:
+    """Exposes the worker's realtime sender counters at scrape time."""
+
+    def __init__(self, sender):
+        self.sender = sender
+
+    def collect(self):
+        stats = self.sender.stats()
+        events = CounterMetricFamily(
+            'hermes_realtime_events', 'Realtime events by what happened to them', labels=['result']
+        )
+        for result in ('queued', 'sent', 'failed', 'dropped', 'coalesced', 'delayed'):
+            events.add_metric([result], stats[result])
+        yield events
+        yield GaugeMetricFamily('hermes_realtime_events_pending', 'Realtime events waiting to be published',
+                                value=stats['pending'])
+
+_collectors = set()
+
+def register_realtime_sender(sender):
+    """Add the sender's counters to the default registry (once per process)."""
+    if id(sender) not in _collectors:
+        REGISTRY.register(RealtimeSenderCollector(sender))
+        _collectors.add(id(sender))
+
+def start_worker_metrics_server(port=None):
+    """Serve this worker's metrics over HTTP. Returns False if disabled."""
+    port = WORKER_METRICS_PORT if port is None else port
+    if not port:
+        return False
+    start_http_server(port)
+    return True
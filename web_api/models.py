@@ -1,8 +1,16 @@
 # web_api/models.py
-from sqlalchemy import Enum, Text, String, Integer, DateTime, func, Boolean
+from sqlalchemy import Enum, Text, String, Integer, BigInteger, DateTime, func, Boolean, LargeBinary, ForeignKey, UniqueConstraint, Index
+from datetime import datetime, timezone
 from extensions import db
 from werkzeug.security import generate_password_hash, check_password_hash
 
+# Statuses after which an execution's output no longer changes
+FINISHED_STATUSES = ("success", "failure", "cancelled", "timeout")
+
+def utcnow():
+    # Naive UTC, like the timestamps the database writes
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 class User(db.Model):
     __tablename__ = 'users'
 
@@ -21,20 +29,146 @@ class User(db.Model):
 
 class CommandExecution(db.Model):
     __tablename__ = 'command_executions'
+    # History is listed newest first, optionally filtered by one column, and
+    # paged with a (start_time, id) cursor; each index serves one of those shapes.
+    __table_args__ = (
+        Index('ix_command_executions_start_time_id', 'start_time', 'id'),
+        Index('ix_command_executions_status_start_time_id', 'status', 'start_time', 'id'),
+        Index('ix_command_executions_target_host_start_time_id', 'target_host', 'start_time', 'id'),
+        Index('ix_command_executions_command_name_start_time_id', 'command_name', 'start_time', 'id'),
+        Index('ix_command_executions_user_start_time_id', 'user', 'start_time', 'id'),
+    )
 
     id           = db.Column(Integer, primary_key=True)
     command_name = db.Column(String(255), nullable=False)
     target_host  = db.Column(String(255), nullable=False)
     user         = db.Column(String(255), nullable=False)
-    start_time   = db.Column(DateTime, server_default=func.now())
+    # Set here rather than by the database: SQLite's CURRENT_TIMESTAMP has whole
+    # seconds only, and the (start_time, id) cursor must tell apart rows
+    # inserted in the same second
+    start_time   = db.Column(DateTime, default=utcnow, server_default=func.now())
     end_time     = db.Column(DateTime, nullable=True)
     status       = db.Column(
                      Enum(
-                       "pending", "running", "success", "failure",
+                       "pending", "running", "success", "failure", "cancelled", "timeout",
                        name="execution_status"
                      ),
                      default="pending"
                    )
-    output       = db.Column(Text, nullable=True)
+    # Output recorded before chunked storage existed. New executions leave this
+    # empty and append ExecutionOutputChunk rows instead.
+    legacy_output = db.Column('output', Text, nullable=True)
+    # Once an execution finishes its output is compressed into one blob and the chunks are dropped
+    output_compressed = db.Column(LargeBinary, nullable=True)
+    output_encoding   = db.Column(String(16), nullable=True)  # zlib or zstd
+    output_size       = db.Column(BigInteger, nullable=True)  # uncompressed size in bytes
+    # Output too large for the database is written to this file under OUTPUT_SPILL_DIR instead
+    output_path       = db.Column(String(255), nullable=True)
     exit_code    = db.Column(Integer, nullable=True)
     error        = db.Column(Text, nullable=True)
+    params       = db.Column(Text, nullable=True)  # JSON list of the script arguments
+    run_id       = db.Column(Integer, ForeignKey('execution_runs.id'), nullable=True, index=True)  # set for fan-out executions
+    leader_id    = db.Column(Integer, ForeignKey('command_executions.id'), nullable=True, index=True)  # set on coalesced followers
+    job_id       = db.Column(Integer, ForeignKey('scheduled_jobs.id'), nullable=True, index=True)  # set for scheduled executions
+    cancel_requested_at = db.Column(DateTime, nullable=True)  # POST /cancel was called; the worker stops the run
+
+    timing = db.relationship('ExecutionTiming', uselist=False, lazy='select', cascade='all, delete-orphan')
+
+    output_chunks = db.relationship(
+        'ExecutionOutputChunk',
+        order_by='ExecutionOutputChunk.seq',
+        lazy='select',
+        cascade='all, delete-orphan'
+    )
+
+    @property
+    def output(self):
+        """Full output, assembled from the stored chunks only when accessed."""
+        if self.output_path is not None:
+            from output_store import read_spilled_output
+            return read_spilled_output(self).decode('utf-8', errors='replace')
+        if self.output_compressed is not None:
+            from output_store import decompress_output
+            return decompress_output(self.output_compressed, self.output_encoding).decode('utf-8', errors='replace')
+        if self.legacy_output:
+            return self.legacy_output
+        return b''.join(chunk.data for chunk in self.output_chunks).decode('utf-8', errors='replace')
+
+class ExecutionRun(db.Model):
+    """One command fanned out to many hosts; each host gets its own CommandExecution."""
+    __tablename__ = 'execution_runs'
+
+    id           = db.Column(Integer, primary_key=True)
+    command_name = db.Column(String(255), nullable=False)
+    user         = db.Column(String(255), nullable=False)
+    host_group   = db.Column(String(255), nullable=True)
+    host_count   = db.Column(Integer, nullable=False)
+    parallelism  = db.Column(Integer, nullable=False)
+    created_at   = db.Column(DateTime, server_default=func.now())
+
+class ScheduledJob(db.Model):
+    """
+    A command run on a set of hosts on an interval or a cron expression,
+    dispatched by the scheduler (see scheduler.py).
+    """
+    __tablename__ = 'scheduled_jobs'
+
+    id               = db.Column(Integer, primary_key=True)
+    name             = db.Column(String(255), unique=True, nullable=False)
+    command_name     = db.Column(String(255), nullable=False)
+    params           = db.Column(Text, nullable=True)  # JSON list of the script arguments
+    target_hosts     = db.Column(Text, nullable=True)  # JSON list of hosts
+    host_group       = db.Column(String(255), nullable=True)  # resolved through HOST_GROUPS at every firing
+    interval_seconds = db.Column(Integer, nullable=True)  # either this...
+    cron             = db.Column(String(255), nullable=True)  # ...or a cron expression (needs croniter)
+    jitter_seconds   = db.Column(Integer, nullable=False, default=0)  # hosts start spread over this window
+    catch_up         = db.Column(String(16), nullable=False, default='once')  # skip, once or all
+    enabled          = db.Column(Boolean, nullable=False, default=True)
+    user             = db.Column(String(255), nullable=False)
+    created_at       = db.Column(DateTime, server_default=func.now())
+    # The firing being dispatched (or the next one) and how far into its jitter window hosts were started
+    next_run_at      = db.Column(DateTime, nullable=True, index=True)
+    dispatched_through = db.Column(DateTime, nullable=True)
+    last_run_at      = db.Column(DateTime, nullable=True)  # the last firing that was fully dispatched
+
+class SchedulerLease(db.Model):
+    """Which scheduler process may dispatch jobs, until when. One row per lease name."""
+    __tablename__ = 'scheduler_leases'
+
+    name       = db.Column(String(64), primary_key=True)
+    holder     = db.Column(String(255), nullable=False)
+    expires_at = db.Column(DateTime, nullable=False)
+
+class ExecutionOutputChunk(db.Model):
+    """
+    A piece of streamed output. Workers only ever insert these rows, so writing
+    a line costs the size of the line rather than the size of the whole output.
+    """
+    __tablename__ = 'execution_output_chunks'
+    __table_args__ = (
+        UniqueConstraint('execution_id', 'seq', name='uq_execution_output_chunks_seq'),
+    )
+
+    id           = db.Column(Integer, primary_key=True)
+    execution_id = db.Column(Integer, ForeignKey('command_executions.id', ondelete='CASCADE'), nullable=False)
+    seq          = db.Column(Integer, nullable=False)
+    byte_offset  = db.Column(BigInteger, nullable=False, default=0)  # position of the first byte in the whole output
+    stream       = db.Column(String(16), nullable=False, default='stdout')  # stdout, stderr or system
+    data         = db.Column(LargeBinary, nullable=False)
+
+class ExecutionTiming(db.Model):
+    """
+    When an execution reached each stage of its life, to tell broker backlog,
+    agent and database latency apart. Timestamps are naive UTC with
+    sub-second precision; a stage that was never reached stays empty.
+    """
+    __tablename__ = 'execution_timings'
+
+    execution_id       = db.Column(Integer, ForeignKey('command_executions.id', ondelete='CASCADE'), primary_key=True)
+    submitted_at       = db.Column(DateTime, nullable=True, index=True)  # the row was created by the web app
+    dequeued_at        = db.Column(DateTime, nullable=True)  # a worker first picked the task up
+    agent_connected_at = db.Column(DateTime, nullable=True)  # the agent accepted the request
+    first_byte_at      = db.Column(DateTime, nullable=True)  # the first output record arrived
+    last_byte_at       = db.Column(DateTime, nullable=True)  # the agent's stream ended
+    persisted_at       = db.Column(DateTime, nullable=True)  # the final status and output were committed
+    attempts           = db.Column(Integer, nullable=False, default=0)  # times a worker picked the task up
@@ -0,0 +1,346 @@
+# web_api/output_store.py
+"""
+Append-only storage for command output.
+
+Workers add ExecutionOutputChunk rows as output arrives; readers put the
+chunks back together in sequence order. When an execution finishes its
+chunks are replaced by one compressed copy, or, above OUTPUT_SPILL_THRESHOLD,
+by a plain file under OUTPUT_SPILL_DIR that is read through mmap one page at
+a time, so serving it never loads the whole output.
+"""
+import os
+import mmap
+import time
+import zlib
+import logging
+from sqlalchemy import select, delete, func
+from models import ExecutionOutputChunk
+
+logger = logging.getLogger(__name__)
+
+# zstd is optional; without it finished output is compressed with zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Streamed output is committed when it is this old or this large, whichever comes first
+OUTPUT_FLUSH_INTERVAL_MS = int(os.getenv('OUTPUT_FLUSH_INTERVAL_MS', '250'))
+OUTPUT_FLUSH_MAX_BYTES = int(os.getenv('OUTPUT_FLUSH_MAX_BYTES', str(64 * 1024)))
+
+# How finished output is stored: zlib, zstd or none
+OUTPUT_COMPRESSION = os.getenv('OUTPUT_COMPRESSION', 'zlib').lower()
+
+# HTTP Content-Encoding matching each stored encoding ("deflate" is zlib-wrapped data)
+CONTENT_ENCODINGS = {'zlib': 'deflate', 'zstd': 'zstd'}
+
+# Finished output larger than this many bytes is written to a file instead of
+# the database; 0 keeps all output in the database
+OUTPUT_SPILL_THRESHOLD = int(os.getenv('OUTPUT_SPILL_THRESHOLD', str(1024 * 1024)))
+# Shared by the web app and the workers (the data volume in docker-compose.yml)
+OUTPUT_SPILL_DIR = os.getenv(
+    'OUTPUT_SPILL_DIR', os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'outputs'))
+)
+# Most output bytes returned by one read, e.g. one /api/output response
+OUTPUT_PAGE_BYTES = int(os.getenv('OUTPUT_PAGE_BYTES', str(1024 * 1024)))
+
+def next_chunk_position(session, execution_id):
+    """Return the (seq, byte_offset) the next chunk of an execution should use."""
+    last_chunk = session.execute(
+        select(ExecutionOutputChunk.seq, ExecutionOutputChunk.byte_offset, func.length(ExecutionOutputChunk.data))
+        .where(ExecutionOutputChunk.execution_id == execution_id)
+        .order_by(ExecutionOutputChunk.seq.desc())
+        .limit(1)
+    ).first()
+    if last_chunk is None:
+        return 0, 0
+    seq, byte_offset, size = last_chunk
+    return seq + 1, byte_offset + size
+
+class OutputWriter:
+    """Appends output chunks for a single execution, keeping them in order."""
+
+    def __init__(self, session, execution_id):
+        self.session = session
+        self.execution_id = execution_id
+        self.resync()
+
+    def resync(self):
+        """Continue after the last stored chunk, e.g. once a rollback dropped the staged ones."""
+        self.next_seq, self.next_offset = next_chunk_position(self.session, self.execution_id)
+
+    def write(self, text, stream='stdout'):
+        """Stage one piece of output. The caller decides when to commit."""
+        if not text.endswith('\n'):
+            text += '\n'
+        self.write_bytes(text.encode('utf-8'), stream)
+
+    def write_bytes(self, data, stream='stdout'):
+        """Stage already encoded output as the next chunk."""
+        self.session.add(ExecutionOutputChunk(
+            execution_id=self.execution_id,
+            seq=self.next_seq,
+            stream=stream,
+            byte_offset=self.next_offset,
+            data=data
+        ))
+        self.next_seq += 1
+        self.next_offset += len(data)
+
+class OutputBuffer:
+    """
+    Collects output for one execution and writes it in batches.
+
+    Buffered output is committed once it is flush_interval_ms old or has grown
+    to flush_max_bytes, whichever comes first. Consecutive lines from the same
+    stream are stored as a single chunk. Callers must flush() when the
+    execution finishes so nothing is left behind.
+    """
+
+    def __init__(self, session, execution_id, flush_interval_ms=None, flush_max_bytes=None, clock=time.monotonic,
+                 commit_observer=None):
+        self.session = session
+        self.commit_observer = commit_observer  # called with the duration of each commit
+        self.writer = OutputWriter(session, execution_id)
+        self.flush_interval_ms = OUTPUT_FLUSH_INTERVAL_MS if flush_interval_ms is None else flush_interval_ms
+        self.flush_max_bytes = OUTPUT_FLUSH_MAX_BYTES if flush_max_bytes is None else flush_max_bytes
+        self.clock = clock
+        self.pending_bytes = 0
+        self.commits = 0
+        self._pending = []  # [stream, [encoded lines]] groups, in arrival order
+        self._oldest = None
+
+    def append(self, text, stream='stdout'):
+        """Buffer one line of output, flushing if a bound has been reached."""
+        if not text.endswith('\n'):
+            text += '\n'
+        data = text.encode('utf-8')
+        if self._pending and self._pending[-1][0] == stream:
+            self._pending[-1][1].append(data)
+        else:
+            self._pending.append([stream, [data]])
+        self.pending_bytes += len(data)
+        if self._oldest is None:
+            self._oldest = self.clock()
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        """Flush when the buffered output is too old or too large."""
+        if self._oldest is None:
+            return False
+        too_old = (self.clock() - self._oldest) * 1000 >= self.flush_interval_ms
+        if too_old or self.pending_bytes >= self.flush_max_bytes:
+            return self.flush()
+        return False
+
+    def flush(self, commit=True):
+        """
+        Stage everything buffered as chunks. With commit=False the caller
+        commits, e.g. together with the final status of the execution.
+        """
+        if not self._pending:
+            return False
+        for stream, lines in self._pending:
+            self.writer.write_bytes(b''.join(lines), stream)
+        self._pending = []
+        self.pending_bytes = 0
+        self._oldest = None
+        if commit:
+            started = time.perf_counter()
+            self.session.commit()
+            self.commits += 1
+            if self.commit_observer:
+                self.commit_observer(time.perf_counter() - started)
+        return True
+
+def read_output_since(session, execution, since=0):
+    """
+    Return (data, next_offset): the output bytes from byte offset `since`
+    onwards and the offset to ask for next time.
+    """
+    data, next_offset, _ = read_output_page(session, execution, since)
+    return data, next_offset
+
+def read_output_page(session, execution, since=0, limit=None):
+    """
+    Like read_output_since(), but return at most `limit` bytes, cut after the
+    last complete line when there is one. Returns (data, next_offset, more);
+    `more` is True if output beyond this page is already stored.
+    """
+    if execution.output_path is not None:
+        data = read_spilled_output(execution, since, None if limit is None else limit + 1)
+        data, more = cut_page(data, limit)
+        return data, since + len(data), more
+
+    if execution.output_compressed is not None:
+        full = decompress_output(execution.output_compressed, execution.output_encoding)
+        data, more = cut_page(full[since:], limit)
+        return data, since + len(data), more
+
+    if execution.legacy_output:
+        full = execution.legacy_output.encode('utf-8')
+        data, more = cut_page(full[since:], limit)
+        return data, since + len(data), more
+
+    chunks = session.execute(
+        select(ExecutionOutputChunk.byte_offset, ExecutionOutputChunk.data)
+        .where(
+            ExecutionOutputChunk.execution_id == execution.id,
+            ExecutionOutputChunk.byte_offset + func.length(ExecutionOutputChunk.data) > since
+        )
+        .order_by(ExecutionOutputChunk.seq)
+        .execution_options(yield_per=100)
+    )
+    parts = []
+    size = 0
+    for byte_offset, chunk in chunks:
+        # The first chunk may start before the requested offset
+        piece = chunk[max(0, since - byte_offset):]
+        parts.append(piece)
+        size += len(piece)
+        if limit is not None and size > limit:
+            break
+    chunks.close()
+    data, more = cut_page(b''.join(parts), limit)
+    return data, since + len(data), more
+
+def cut_page(data, limit):
+    """
+    Trim `data` to at most `limit` bytes, ending after a newline if there is
+    one, so pages don't split lines. Returns (data, more).
+    """
+    if limit is None or len(data) <= limit:
+        return data, False
+    data = data[:limit]
+    end = data.rfind(b'\n')
+    if end >= 0:
+        data = data[:end + 1]
+    return data, True
+
+def spill_path(execution):
+    """Absolute path of an execution's spilled output file."""
+    return os.path.join(OUTPUT_SPILL_DIR, execution.output_path)
+
+def read_spilled_output(execution, start=0, size=None):
+    """Read `size` bytes (or up to the end) from `start` of a spilled output file via mmap."""
+    with open(spill_path(execution), 'rb') as f:
+        length = os.fstat(f.fileno()).st_size
+        if start >= length:
+            return b''
+        end = length if size is None else min(length, start + size)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            return view[start:end]
+
+def iter_output(session, execution, batch_size=100):
+    """Yield the stored output of an execution piece by piece, in order."""
+    if execution.output_path is not None:
+        with open(spill_path(execution), 'rb') as f:
+            yield from iter(lambda: f.read(64 * 1024), b'')
+        return
+
+    if execution.output_compressed is not None:
+        yield from iter_decompressed(execution.output_compressed, execution.output_encoding)
+        return
+
+    if execution.legacy_output:
+        yield execution.legacy_output.encode('utf-8')
+        return
+
+    chunks = session.execute(
+        select(ExecutionOutputChunk.data)
+        .where(ExecutionOutputChunk.execution_id == execution.id)
+        .order_by(ExecutionOutputChunk.seq)
+        .execution_options(yield_per=batch_size)
+    ).scalars()
+    yield from chunks
+
+def compress_output(data, encoding=None):
+    """Compress output bytes, returning (blob, encoding)."""
+    encoding = encoding or OUTPUT_COMPRESSION
+    if encoding == 'zstd':
+        if zstandard is not None:
+            return zstandard.ZstdCompressor().compress(data), 'zstd'
+        logger.warning("zstandard is not installed, compressing output with zlib instead")
+        encoding = 'zlib'
+    if encoding == 'zlib':
+        return zlib.compress(data), 'zlib'
+    raise ValueError(f"Unknown output compression: {encoding}")
+
+def decompress_output(blob, encoding):
+    """Inflate output stored by compress_output()."""
+    return b''.join(iter_decompressed(blob, encoding))
+
+def iter_decompressed(blob, encoding, piece_size=64 * 1024):
+    """Inflate stored output incrementally so a download never holds it all."""
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Output is zstd-compressed but zstandard is not installed")
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    elif encoding == 'zlib':
+        decompressor = zlib.decompressobj()
+    else:
+        raise ValueError(f"Unknown output compression: {encoding}")
+    for start in range(0, len(blob), piece_size):
+        data = decompressor.decompress(blob[start:start + piece_size])
+        if data:
+            yield data
+    if encoding == 'zlib':
+        data = decompressor.flush()
+        if data:
+            yield data
+
+def stored_output_size(session, execution):
+    """Bytes of output stored in the database for an execution that isn't finalized yet."""
+    if execution.legacy_output:
+        return len(execution.legacy_output.encode('utf-8'))
+    return session.scalar(
+        select(func.coalesce(func.sum(func.length(ExecutionOutputChunk.data)), 0))
+        .where(ExecutionOutputChunk.execution_id == execution.id)
+    )
+
+def spill_output(session, execution):
+    """
+    Write the output of an execution to its file under OUTPUT_SPILL_DIR,
+    streaming the chunks so it is never held in memory. The file is complete
+    before it is renamed into place.
+    """
+    os.makedirs(OUTPUT_SPILL_DIR, exist_ok=True)
+    file_name = f"{execution.id}.log"
+    path = os.path.join(OUTPUT_SPILL_DIR, file_name)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'wb') as f:
+        for piece in iter_output(session, execution):
+            f.write(piece)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    return file_name
+
+def finalize_output(session, execution):
+    """
+    Replace the chunks of a finished execution with a single compressed copy
+    of its output, or with a file if it is larger than OUTPUT_SPILL_THRESHOLD.
+    Runs in the caller's transaction, so commit it together with the final
+    status.
+    """
+    if execution.output_compressed is not None or execution.output_path is not None:
+        return False
+
+    size = stored_output_size(session, execution)
+    if OUTPUT_SPILL_THRESHOLD and size > OUTPUT_SPILL_THRESHOLD:
+        execution.output_path = spill_output(session, execution)
+        execution.output_size = size
+        execution.legacy_output = None
+        session.execute(delete(ExecutionOutputChunk).where(ExecutionOutputChunk.execution_id == execution.id))
+        logger.info(f"Output of execution {execution.id} ({size} bytes) written to {spill_path(execution)}")
+        return True
+
+    if OUTPUT_COMPRESSION == 'none':
+        return False
+
+    data = b''.join(iter_output(session, execution))
+    execution.output_compressed, execution.output_encoding = compress_output(data)
+    execution.output_size = len(data)
+    execution.legacy_output = None
+    session.execute(delete(ExecutionOutputChunk).where(ExecutionOutputChunk.execution_id == execution.id))
+    return True
@@ -0,0 +1,114 @@
+# web_api/result_cache.py
+"""
+Answering repeated read-only commands from a recent successful execution.
+
+Commands listed in CACHEABLE_COMMANDS (name -> TTL in seconds) are looked up
+by (command_name, target_host, params) before anything is dispatched. Hot
+keys are kept in a size-bounded LRU so a repeated probe costs no database
+query; on a miss the latest matching successful execution is looked up and,
+if it finished within the TTL, remembered.
+"""
+import os
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import select
+from models import CommandExecution
+
+# Commands whose successful results may be reused, e.g. '{"say_hello.sh": 30}'
+CACHEABLE_COMMANDS = {
+    name: float(ttl) for name, ttl in json.loads(os.getenv('CACHEABLE_COMMANDS', '{}')).items()
+}
+# Most (command, host, params) keys remembered in memory at once
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '1024'))
+
+def params_key(params):
+    """Canonical JSON for a parameter list, as stored in CommandExecution.params."""
+    return json.dumps(list(params or []), separators=(',', ':'))
+
+def utcnow():
+    # end_time is written by the database as naive UTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+class ResultCache:
+    """LRU of (command_name, target_host, params) -> (execution_id, finished_at, expires_at)."""
+
+    def __init__(self, ttls, max_entries):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def ttl(self, command_name):
+        """TTL in seconds for a command, or None if it is not cacheable."""
+        return self.ttls.get(command_name)
+
+    def lookup(self, session, command_name, target_host, params):
+        """
+        Return (execution_id, finished_at) of a reusable execution, or None.
+        Non-cacheable commands return None without counting as a miss.
+        """
+        ttl = self.ttl(command_name)
+        if not ttl:
+            return None
+        key = (command_name, target_host, params_key(params))
+        now = utcnow()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[2] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0], entry[1]
+                del self._entries[key]
+
+        row = session.execute(
+            select(CommandExecution.id, CommandExecution.end_time)
+            .where(
+                CommandExecution.command_name == command_name,
+                CommandExecution.target_host == target_host,
+                CommandExecution.params == key[2],
+                CommandExecution.status == 'success',
+                CommandExecution.end_time >= now - timedelta(seconds=ttl)
+            )
+            .order_by(CommandExecution.end_time.desc())
+            .limit(1)
+        ).first()
+
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._store(key, (row.id, row.end_time, row.end_time + timedelta(seconds=ttl)))
+        return row.id, row.end_time
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'cacheable_commands': self.ttls,
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': round(self.hits / lookups, 3) if lookups else None
+        }
+
+result_cache = ResultCache(CACHEABLE_COMMANDS, RESULT_CACHE_MAX_ENTRIES)
@@ -1,15 +1,110 @@
-from flask import Blueprint, render_template, request, jsonify, redirect
-from sqlalchemy.orm import scoped_session, sessionmaker
-from sqlalchemy import text
-from extensions import db
-from models import CommandExecution
+from flask import Blueprint, render_template, request, jsonify, redirect, make_response, Response, stream_with_context, send_file
+import json
+import time
+import requests
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from datetime import datetime
+from sqlalchemy import text, func, or_, and_
+from models import CommandExecution, ExecutionRun, ExecutionTiming, ScheduledJob, FINISHED_STATUSES
+from output_store import read_output_page, iter_output, iter_decompressed, spill_path, CONTENT_ENCODINGS, OUTPUT_PAGE_BYTES
 from tasks import execute_command
+from dispatch import resolve_hosts, fan_out, submit_batch, HOST_GROUPS, BATCH_MAX_SIZE
+from command_catalog import get_catalog, is_known_command, command_names
+from result_cache import result_cache, params_key
+from coalesce import find_inflight_leader, attach_follower, output_source, sync_followers, dispatch_promoted
+from timings import serialize_timing, summarize, utcnow, PERCENTILES
+from scheduler import validate_schedule, next_firing
 from auth import token_required, admin_required
+from storage import get_session
+import agent_client
+import metrics
 
 main = Blueprint('main', __name__)
 
-def get_session():
-    return scoped_session(sessionmaker(bind=db.engine))
+# Columns that /api/executions can be filtered on with an exact match
+EXECUTION_FILTERS = ('status', 'target_host', 'command_name', 'user')
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+# Most recent executions the latency percentiles are computed over
+LATENCY_SAMPLE_SIZE = 1000
+MAX_LATENCY_SAMPLE_SIZE = 10000
+# Seconds to wait for an agent to acknowledge a cancellation
+AGENT_CANCEL_TIMEOUT = 5
+
+def serialize_execution(exe):
+    """Convert a CommandExecution into the dictionary the API returns."""
+    return {
+        'id': exe.id,
+        'command_name': exe.command_name,
+        'target_host': exe.target_host,
+        'status': exe.status,
+        'start_time': exe.start_time.isoformat() if exe.start_time else None,
+        'end_time': exe.end_time.isoformat() if exe.end_time else None,
+        'exit_code': exe.exit_code,
+        'user': exe.user,
+        'params': json.loads(exe.params) if exe.params else None,
+        'coalesced_with': exe.leader_id
+    }
+
+def serialize_job(job):
+    """Convert a ScheduledJob into the dictionary the API returns."""
+    return {
+        'id': job.id,
+        'name': job.name,
+        'command_name': job.command_name,
+        'params': json.loads(job.params) if job.params else [],
+        'target_hosts': json.loads(job.target_hosts) if job.target_hosts else [],
+        'host_group': job.host_group,
+        'interval_seconds': job.interval_seconds,
+        'cron': job.cron,
+        'jitter_seconds': job.jitter_seconds,
+        'catch_up': job.catch_up,
+        'enabled': job.enabled,
+        'user': job.user,
+        'next_run_at': job.next_run_at.isoformat() if job.next_run_at else None,
+        'last_run_at': job.last_run_at.isoformat() if job.last_run_at else None
+    }
+
+# Fields of a ScheduledJob that POST and PATCH /api/schedules accept
+JOB_FIELDS = ('name', 'command_name', 'params', 'target_hosts', 'host_group',
+              'interval_seconds', 'cron', 'jitter_seconds', 'catch_up', 'enabled')
+
+def apply_job_fields(job, data):
+    """Copy the fields present in `data` onto `job` and check the result. Raises ValueError (or TypeError for values of the wrong type)."""
+    for field in JOB_FIELDS:
+        if field not in data:
+            continue
+        value = data[field]
+        if field == 'params':
+            value = params_key(value)
+        elif field == 'target_hosts':
+            if value is not None and not isinstance(value, list):
+                raise ValueError('target_hosts must be a list')
+            value = json.dumps(list(dict.fromkeys(value or [])))
+        elif field in ('interval_seconds', 'jitter_seconds') and value is not None:
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise ValueError(f'{field} must be a whole number')
+        setattr(job, field, value)
+    if not job.name or not job.command_name:
+        raise ValueError('name and command_name are required')
+    if not resolve_hosts(json.loads(job.target_hosts) if job.target_hosts else None, job.host_group):
+        raise ValueError('target_hosts or host_group is required')
+    validate_schedule(job.interval_seconds, job.cron, job.catch_up, job.jitter_seconds)
+
+def parse_cursor(cursor):
+    """Parse a '<start_time>,<id>' pagination cursor."""
+    start_time, _, execution_id = cursor.rpartition(',')
+    return datetime.fromisoformat(start_time), int(execution_id)
+
+def filter_executions(query, args):
+    """Apply the exact-match filters present in the request arguments."""
+    for name in EXECUTION_FILTERS:
+        value = args.get(name)
+        if value:
+            query = query.filter(getattr(CommandExecution, name) == value)
+    return query
 
 @main.route('/health')
 def health_check():
@@ -58,11 +153,41 @@ def trigger_command():
         # Use the authenticated user from the token
         user = request.username
 
+        # Reject commands the target's agent doesn't have before anything is queued
+        if is_known_command(target_host, command_name) is False:
+            return jsonify({'error': f"Command '{command_name}' is not available on {target_host}"}), 400
+
+        # Read-only commands may be answered by a recent successful run
+        if not data.get('no_cache'):
+            cached = result_cache.lookup(session, command_name, target_host, params)
+            if cached:
+                cached_id, finished_at = cached
+                metrics.EXECUTIONS_SUBMITTED.labels(command_name, target_host, 'cached').inc()
+                return jsonify({
+                    'execution_id': cached_id,
+                    'status': 'success',
+                    'cached': True,
+                    'cached_at': finished_at.isoformat() if finished_at else None
+                }), 200
+
+        # Opt-in single flight: join an identical run that is already in progress
+        if data.get('coalesce'):
+            leader = find_inflight_leader(session, command_name, target_host, params_key(params))
+            if leader:
+                follower = attach_follower(session, leader, user)
+                metrics.EXECUTIONS_SUBMITTED.labels(command_name, target_host, 'coalesced').inc()
+                result = {'execution_id': follower.id, 'status': follower.status, 'coalesced_with': leader.id}
+                if stream_to_ui:
+                    result.update(stream_url=f"/stream-output/{follower.id}", redirect=True)
+                return jsonify(result), 202
+
         # Create a CommandExecution record in the database
         execution = CommandExecution(
             command_name=command_name,
             target_host=target_host,
-            user=user
+            user=user,
+            params=params_key(params),
+            timing=ExecutionTiming(submitted_at=utcnow(), attempts=0)
         )
         session.add(execution)
         session.commit()
@@ -70,7 +195,8 @@ def trigger_command():
         execution_id = execution.id
 
         # Trigger the Celery task
-        task = execute_command.delay(execution_id, command_name, target_host, params, user)
+        task = execute_command.delay(execution_id, command_name, target_host, params, user, submitted_at=time.time())
+        metrics.EXECUTIONS_SUBMITTED.labels(command_name, target_host, 'dispatched').inc()
         
         # If direct streaming to UI is requested, return redirect info
         if stream_to_ui:
@@ -93,10 +219,300 @@ def trigger_command():
     finally:
         session.remove()
 
+@main.route('/api/commands')
+@token_required
+def list_commands():
+    """
+    Command catalogs of the target hosts, from the per-host cache.
+    Defaults to every host in the "all" group; ?host= may be repeated.
+    """
+    hosts = request.args.getlist('host') or HOST_GROUPS.get('all', [])
+    catalogs = {}
+    for host in hosts:
+        catalog = get_catalog(host)
+        catalogs[host] = {
+            'available': catalog is not None,
+            'version': catalog.get('version') if catalog else None,
+            'commands': catalog.get('commands', []) if catalog else []
+        }
+    return jsonify({'hosts': catalogs})
+
+@main.route('/metrics')
+def prometheus_metrics():
+    """Prometheus metrics of the web app. No authentication, like /health."""
+    return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
+
+@main.route('/api/cache/stats')
+@token_required
+def cache_stats():
+    """Hit/miss counters and size of this process's result cache."""
+    return jsonify(result_cache.stats())
+
+@main.route('/execute_fanout', methods=['POST'])
+@token_required
+def trigger_fanout():
+    """
+    Runs one command on many hosts. Accepts a list of target_hosts and/or a
+    host_group, plus optional params and parallelism (how many hosts may run
+    at once). Returns a run id whose progress is available at /runs/<run_id>.
+    Requires authentication.
+    """
+    session = get_session()
+    try:
+        data = request.get_json()
+        command_name = data.get('command_name')
+        params = data.get('params', [])
+        host_group = data.get('host_group')
+        parallelism = data.get('parallelism')
+
+        if not command_name:
+            return jsonify({'error': 'command_name is required'}), 400
+        try:
+            hosts = resolve_hosts(data.get('target_hosts'), host_group)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if not hosts:
+            return jsonify({'error': 'target_hosts or host_group is required'}), 400
+
+        run, execution_ids = fan_out(
+            session, command_name, hosts, params, request.username,
+            parallelism=parallelism, host_group=host_group
+        )
+
+        return jsonify({
+            'run_id': run.id,
+            'execution_ids': execution_ids,
+            'host_count': len(hosts),
+            'parallelism': run.parallelism,
+            'status_url': f"/runs/{run.id}",
+            'status': 'pending'
+        }), 202
+
+    except Exception as e:
+        session.rollback()
+        return jsonify({'error': f'Failed to trigger fan-out: {str(e)}'}), 500
+    finally:
+        session.remove()
+
+def validate_batch_item(item):
+    """Return (command_name, target_host, params) of one batch item, or raise ValueError."""
+    if not isinstance(item, dict):
+        raise ValueError('must be an object')
+    command_name = item.get('command_name')
+    target_host = item.get('target_host')
+    params = item.get('params', [])
+    if not command_name or not isinstance(command_name, str):
+        raise ValueError('command_name is required')
+    if not target_host or not isinstance(target_host, str):
+        raise ValueError('target_host is required')
+    if not isinstance(params, list):
+        raise ValueError('params must be a list')
+    return command_name, target_host, params
+
+@main.route('/execute_batch', methods=['POST'])
+@token_required
+def trigger_batch():
+    """
+    Runs many different commands at once. Accepts {"executions": [{"command_name",
+    "target_host", "params"}, ...]}. The whole batch is validated first; if any
+    item is invalid nothing is queued and the errors are returned by index.
+    Otherwise all executions are inserted in one transaction, their tasks
+    published over one broker connection, and the execution ids returned in
+    request order. Batches skip the result cache and coalescing.
+    Requires authentication.
+    """
+    session = get_session()
+    try:
+        data = request.get_json() or {}
+        executions = data.get('executions')
+        if not isinstance(executions, list) or not executions:
+            return jsonify({'error': 'executions must be a non-empty list'}), 400
+        if len(executions) > BATCH_MAX_SIZE:
+            return jsonify({'error': f'At most {BATCH_MAX_SIZE} executions per batch'}), 400
+
+        items, errors = [], []
+        for index, item in enumerate(executions):
+            try:
+                items.append(validate_batch_item(item))
+            except ValueError as e:
+                items.append(None)
+                errors.append({'index': index, 'error': str(e)})
+
+        # One catalog lookup per host, not one per item
+        available = {host: command_names(host) for host in {item[1] for item in items if item}}
+        for index, item in enumerate(items):
+            if item is None:
+                continue
+            command_name, target_host, _ = item
+            names = available[target_host]
+            if names is not None and command_name not in names:
+                errors.append({'index': index, 'error': f"Command '{command_name}' is not available on {target_host}"})
+        if errors:
+            errors.sort(key=lambda error: error['index'])
+            return jsonify({'error': 'Invalid executions, nothing was queued', 'errors': errors}), 400
+
+        execution_ids = submit_batch(session, items, request.username)
+        return jsonify({'execution_ids': execution_ids, 'count': len(execution_ids), 'status': 'pending'}), 202
+
+    except Exception as e:
+        session.rollback()
+        return jsonify({'error': f'Failed to trigger batch: {str(e)}'}), 500
+    finally:
+        session.remove()
+
+@main.route('/runs/<int:run_id>')
+def get_run(run_id):
+    """
+    Aggregated progress of a fan-out run: execution counts per status and the
+    slowest hosts so far (?slowest=N, default 5).
+    No authentication required - all users can view execution status.
+    """
+    slowest = request.args.get('slowest', default=5, type=int)
+    session = get_session()
+    try:
+        run = session.get(ExecutionRun, run_id)
+        if not run:
+            return jsonify({'error': 'Run not found'}), 404
+
+        status_counts = dict(
+            session.query(CommandExecution.status, func.count(CommandExecution.id))
+            .filter(CommandExecution.run_id == run_id)
+            .group_by(CommandExecution.status)
+            .all()
+        )
+
+        # Executions count from when a worker picked them up (start_time is the
+        # submission, which includes waiting for a free lane); running ones count until now
+        now = datetime.utcnow()
+        durations = []
+        for exe in session.query(
+            CommandExecution.id, CommandExecution.target_host, CommandExecution.status,
+            func.coalesce(ExecutionTiming.dequeued_at, CommandExecution.start_time).label('started'),
+            CommandExecution.end_time
+        ).outerjoin(ExecutionTiming).filter(CommandExecution.run_id == run_id, CommandExecution.status != 'pending'):
+            if exe.started:
+                seconds = ((exe.end_time or now) - exe.started).total_seconds()
+                durations.append({
+                    'execution_id': exe.id,
+                    'target_host': exe.target_host,
+                    'status': exe.status,
+                    'duration_seconds': round(seconds, 3)
+                })
+        durations.sort(key=lambda item: item['duration_seconds'], reverse=True)
+
+        finished = sum(status_counts.get(status, 0) for status in FINISHED_STATUSES)
+        return jsonify({
+            'run_id': run.id,
+            'command_name': run.command_name,
+            'user': run.user,
+            'host_group': run.host_group,
+            'host_count': run.host_count,
+            'parallelism': run.parallelism,
+            'created_at': run.created_at.isoformat() if run.created_at else None,
+            'status_counts': status_counts,
+            'finished': finished,
+            'complete': finished == run.host_count,
+            'slowest': durations[:slowest]
+        }), 200
+    except Exception as e:
+        return jsonify({'error': f'Error fetching run: {str(e)}'}), 500
+    finally:
+        session.remove()
+
+@main.route('/api/schedules')
+@token_required
+def list_schedules():
+    """All scheduled jobs with their next and last firing."""
+    session = get_session()
+    try:
+        jobs = session.query(ScheduledJob).order_by(ScheduledJob.id).all()
+        return jsonify({'schedules': [serialize_job(job) for job in jobs]}), 200
+    except Exception as e:
+        return jsonify({'error': f'Error fetching schedules: {str(e)}'}), 500
+    finally:
+        session.remove()
+
+@main.route('/api/schedules', methods=['POST'])
+@admin_required
+def create_schedule():
+    """
+    Creates a recurring job: command_name, params, target_hosts and/or
+    host_group, and either interval_seconds or cron. Optional jitter_seconds
+    (spread of the hosts' start times) and catch_up (skip, once or all).
+    Requires admin rights.
+    """
+    session = get_session()
+    try:
+        data = request.get_json() or {}
+        now = utcnow()
+        job = ScheduledJob(user=request.username, created_at=now, jitter_seconds=0, catch_up='once', enabled=True)
+        try:
+            apply_job_fields(job, data)
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+        if session.query(ScheduledJob.id).filter_by(name=job.name).first():
+            return jsonify({'error': f"A schedule named '{job.name}' already exists"}), 409
+        job.next_run_at = next_firing(job, now)
+        session.add(job)
+        session.commit()
+        return jsonify(serialize_job(job)), 201
+    except Exception as e:
+        session.rollback()
+        return jsonify({'error': f'Failed to create schedule: {str(e)}'}), 500
+    finally:
+        session.remove()
+
+@main.route('/api/schedules/<int:job_id>', methods=['PATCH'])
+@admin_required
+def update_schedule(job_id):
+    """Changes some fields of a job, e.g. {"enabled": false}. Requires admin rights."""
+    session = get_session()
+    try:
+        job = session.get(ScheduledJob, job_id)
+        if not job:
+            return jsonify({'error': 'Schedule not found'}), 404
+        data = request.get_json() or {}
+        try:
+            apply_job_fields(job, data)
+        except (TypeError, ValueError) as e:
+            session.rollback()
+            return jsonify({'error': str(e)}), 400
+        if {'interval_seconds', 'cron', 'enabled'} & set(data):
+            # Start over from the new schedule rather than catching up on the old one
+            job.next_run_at = next_firing(job, utcnow())
+            job.dispatched_through = None
+        session.commit()
+        return jsonify(serialize_job(job)), 200
+    except Exception as e:
+        session.rollback()
+        return jsonify({'error': f'Failed to update schedule: {str(e)}'}), 500
+    finally:
+        session.remove()
+
+@main.route('/api/schedules/<int:job_id>', methods=['DELETE'])
+@admin_required
+def delete_schedule(job_id):
+    """Deletes a job. Its past executions are kept. Requires admin rights."""
+    session = get_session()
+    try:
+        job = session.get(ScheduledJob, job_id)
+        if not job:
+            return jsonify({'error': 'Schedule not found'}), 404
+        session.query(CommandExecution).filter_by(job_id=job_id).update({'job_id': None})
+        session.delete(job)
+        session.commit()
+        return jsonify({'deleted': job_id}), 200
+    except Exception as e:
+        session.rollback()
+        return jsonify({'error': f'Failed to delete schedule: {str(e)}'}), 500
+    finally:
+        session.remove()
+
 @main.route('/status/<int:execution_id>')
 def get_status(execution_id):
     """
-    Gets the status of a command execution.
+    Gets the status of a command execution, with the timestamps of each stage
+    of its life and the time spent between them (see timings.py).
     No authentication required - all users can view execution status.
     """
     session = get_session()
@@ -105,21 +521,63 @@ def get_status(execution_id):
         if not execution:
             return jsonify({'error': 'Execution not found'}), 404
         
-        return jsonify({
-            'id': execution.id,
-            'command_name': execution.command_name,
-            'target_host': execution.target_host,
-            'status': execution.status,
-            'start_time': execution.start_time.isoformat() if execution.start_time else None,
-            'end_time': execution.end_time.isoformat() if execution.end_time else None,
-            'exit_code': execution.exit_code,
-            'user': execution.user
-        }), 200
+        result = serialize_execution(execution)
+        result['timing'] = serialize_timing(execution.timing)
+        return jsonify(result), 200
     except Exception as e:
         return jsonify({'error': f'Error fetching status: {str(e)}'}), 500
     finally:
         session.remove()
 
+@main.route('/cancel/<int:execution_id>', methods=['POST'])
+@token_required
+def cancel_execution(execution_id):
+    """
+    Cancels an execution. One that hasn't started is marked cancelled right
+    away and never runs. For a running one the agent is asked to stop the
+    command; the worker records the final status when the stream ends, and
+    also stops reading on its own if the agent couldn't be reached.
+    Only the user who started the execution or an admin may cancel it.
+    """
+    session = get_session()
+    try:
+        execution = session.get(CommandExecution, execution_id)
+        if not execution:
+            return jsonify({'error': 'Execution not found'}), 404
+        if execution.user != request.username and not request.is_admin:
+            return jsonify({'error': 'Only the user who started an execution or an admin can cancel it'}), 403
+        if execution.status in FINISHED_STATUSES:
+            return jsonify({'error': f"Execution already finished ({execution.status})", 'status': execution.status}), 409
+
+        execution.cancel_requested_at = utcnow()
+        # Nothing runs on behalf of a queued execution or a coalesced follower
+        if execution.status == 'pending' or execution.leader_id is not None:
+            execution.status = 'cancelled'
+            execution.end_time = func.now()
+            promoted = sync_followers(session, execution)
+            session.commit()
+            dispatch_promoted(promoted)
+            return jsonify({'execution_id': execution_id, 'status': 'cancelled'}), 200
+        session.commit()
+
+        agent_notified = False
+        try:
+            response = agent_client.post(
+                execution.target_host, f"/cancel/{execution_id}",
+                timeout=(agent_client.AGENT_CONNECT_TIMEOUT, AGENT_CANCEL_TIMEOUT)
+            )
+            agent_notified = response.status_code == 202
+            response.close()
+        except requests.RequestException:
+            pass  # the worker notices the request and stops reading the stream
+
+        return jsonify({'execution_id': execution_id, 'status': 'cancelling', 'agent_notified': agent_notified}), 202
+    except Exception as e:
+        session.rollback()
+        return jsonify({'error': f'Failed to cancel execution: {str(e)}'}), 500
+    finally:
+        session.remove()
+
 @main.route('/output/<int:execution_id>')
 def get_output(execution_id):
     """
@@ -147,82 +605,218 @@ def get_output(execution_id):
 @main.route('/api/output/<int:execution_id>')
 def get_output_api(execution_id):
     """
-    API endpoint that returns the raw output data for a command execution.
+    API endpoint that returns the output of a command execution.
+    With ?since=<offset> only the bytes after that offset are returned, along
+    with the offset to ask for next and whether the output is complete.
+    At most ?limit= bytes (OUTPUT_PAGE_BYTES by default and at most) are
+    returned at a time, ending on a line boundary; "more" says whether the
+    next page is already available.
+    Finished executions carry a strong ETag so clients can revalidate with a 304.
     No authentication required - all users can view command outputs.
     """
+    since = request.args.get('since', default=0, type=int)
+    if since < 0:
+        return jsonify({'error': 'since must be a non-negative byte offset'}), 400
+    limit = min(request.args.get('limit', default=OUTPUT_PAGE_BYTES, type=int), OUTPUT_PAGE_BYTES)
+    if limit < 1:
+        return jsonify({'error': 'limit must be a positive number of bytes'}), 400
+
     session = get_session()
     try:
         execution = session.get(CommandExecution, execution_id)
         if not execution:
             return jsonify({'error': 'Execution not found'}), 404
-        
-        # Return the output - no auth check required
-        return jsonify({'output': execution.output or ''}), 200
+        # A coalesced follower shows the output of the run it joined
+        execution = output_source(session, execution)
+
+        # Finished output never changes, so the ETag doesn't need the content
+        finished = execution.status in FINISHED_STATUSES
+        etag = None
+        if finished:
+            finished_at = execution.end_time.timestamp() if execution.end_time else 0
+            etag = f"output-{execution.id}-{since}-{limit}-{finished_at:.0f}"
+            if request.if_none_match.contains(etag):
+                response = make_response('', 304)
+                response.set_etag(etag)
+                return response
+
+        data, next_offset, more = read_output_page(session, execution, since, limit)
+
+        # Return the new output - no auth check required
+        response = jsonify({
+            'output': data.decode('utf-8', errors='replace'),
+            'offset': next_offset,
+            'more': more,
+            'complete': finished and not more,
+            'status': execution.status
+        })
+        if etag:
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+        else:
+            response.headers['Cache-Control'] = 'no-store'
+        return response, 200
     except Exception as e:
         return jsonify({'error': f'Error fetching output: {str(e)}'}), 500
     finally:
         session.remove()
 
+@main.route('/api/output/<int:execution_id>/download')
+def download_output(execution_id):
+    """
+    Download the full output of a command execution as a text file.
+    Output spilled to a file is sent from disk, with Range request support.
+    Compressed output is sent as stored, with a matching Content-Encoding, to
+    clients that accept it; other clients get it inflated on the fly.
+    No authentication required - all users can view command outputs.
+    """
+    session = get_session()
+    try:
+        execution = session.get(CommandExecution, execution_id)
+        if not execution:
+            return jsonify({'error': 'Execution not found'}), 404
+        # A coalesced follower shows the output of the run it joined
+        execution = output_source(session, execution)
+        source_id = execution.id
+
+        if execution.output_path is not None:
+            return send_file(
+                spill_path(execution), mimetype='text/plain', as_attachment=True,
+                download_name=f"execution-{execution_id}.log", conditional=True, max_age=0
+            )
+
+        headers = {
+            'Content-Disposition': f'attachment; filename="execution-{execution_id}.log"',
+            'Vary': 'Accept-Encoding'
+        }
+        if execution.output_compressed is not None:
+            content_encoding = CONTENT_ENCODINGS.get(execution.output_encoding)
+            if content_encoding and content_encoding in request.accept_encodings:
+                headers['Content-Encoding'] = content_encoding
+                return Response(execution.output_compressed, mimetype='text/plain', headers=headers)
+            blob, encoding = execution.output_compressed, execution.output_encoding
+            return Response(iter_decompressed(blob, encoding), mimetype='text/plain', headers=headers)
+    except Exception as e:
+        return jsonify({'error': f'Error fetching output: {str(e)}'}), 500
+    finally:
+        session.remove()
+
+    # Output that is still being written is streamed chunk by chunk
+    def generate():
+        stream_session = get_session()
+        try:
+            execution = stream_session.get(CommandExecution, source_id)
+            yield from iter_output(stream_session, execution)
+        finally:
+            stream_session.remove()
+
+    return Response(stream_with_context(generate()), mimetype='text/plain', headers=headers)
+
 @main.route('/dashboard')
 def dashboard():
     """
     Dashboard for viewing command execution status and history.
+    Executions are loaded page by page from /api/executions by the browser.
     Authentication is handled client-side by JavaScript.
     """
+    return render_template('dashboard.html')
+
+@main.route('/api/executions')
+@token_required
+def get_executions():
+    """
+    API endpoint to get command executions, newest first, one page at a time.
+    Accepts ?limit=, ?before=<start_time>,<id> (the next_cursor of the previous
+    page) and exact-match filters on status, target_host, command_name and user.
+    Requires authentication.
+    """
+    limit = min(request.args.get('limit', default=DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE)
+    if limit < 1:
+        return jsonify({'error': 'limit must be a positive number'}), 400
+
+    cursor = None
+    if request.args.get('before'):
+        try:
+            cursor = parse_cursor(request.args['before'])
+        except ValueError:
+            return jsonify({'error': 'before must look like <start_time>,<id>'}), 400
+
     session = get_session()
     try:
-        # Return all executions - filtering will happen client-side
-        executions_query = session.query(CommandExecution).order_by(CommandExecution.start_time.desc()).all()
-        
-        # Convert SQLAlchemy objects to dictionaries for JSON serialization
-        executions = []
-        for exe in executions_query:
-            exe_dict = {
-                'id': exe.id,
-                'command_name': exe.command_name,
-                'target_host': exe.target_host,
-                'status': exe.status,
-                'start_time': exe.start_time.isoformat() if exe.start_time else None,
-                'end_time': exe.end_time.isoformat() if exe.end_time else None,
-                'exit_code': exe.exit_code if exe.exit_code is not None else None,
-                'user': exe.user
-            }
-            executions.append(exe_dict)
-        
-        return render_template('dashboard.html', executions=executions)
+        # Return executions for all users regardless of admin status
+        query = filter_executions(session.query(CommandExecution), request.args)
+        if cursor:
+            before_time, before_id = cursor
+            query = query.filter(or_(
+                CommandExecution.start_time < before_time,
+                and_(CommandExecution.start_time == before_time, CommandExecution.id < before_id)
+            ))
+
+        # Fetch one extra row to find out whether there is another page
+        executions = query.order_by(
+            CommandExecution.start_time.desc(), CommandExecution.id.desc()
+        ).limit(limit + 1).all()
+        has_more = len(executions) > limit
+        executions = executions[:limit]
+
+        next_cursor = None
+        if has_more and executions[-1].start_time:
+            last = executions[-1]
+            next_cursor = f"{last.start_time.isoformat()},{last.id}"
+
+        return jsonify({
+            'executions': [serialize_execution(exe) for exe in executions],
+            'next_cursor': next_cursor
+        }), 200
     except Exception as e:
         return jsonify({'error': f'Error fetching executions: {str(e)}'}), 500
     finally:
         session.remove()
 
-@main.route('/api/executions')
+@main.route('/api/executions/stats')
 @token_required
-def get_executions():
+def get_execution_stats():
+    """
+    API endpoint with execution counts per status, using the same filters as
+    /api/executions. Requires authentication.
     """
-    API endpoint to get command executions.
+    session = get_session()
+    try:
+        query = filter_executions(
+            session.query(CommandExecution.status, func.count(CommandExecution.id)),
+            request.args
+        )
+        status_counts = {status: count for status, count in query.group_by(CommandExecution.status).all()}
+        return jsonify({'status_counts': status_counts, 'total': sum(status_counts.values())}), 200
+    except Exception as e:
+        return jsonify({'error': f'Error fetching execution stats: {str(e)}'}), 500
+    finally:
+        session.remove()
+
+@main.route('/api/executions/latency')
+@token_required
+def get_execution_latency():
+    """
+    API endpoint with p50/p90/p99 of each latency phase (queue wait, agent
+    connect, first output, streaming, persist, total) over the most recent
+    ?sample= executions, using the same filters as /api/executions.
     Requires authentication.
     """
+    sample = min(request.args.get('sample', default=LATENCY_SAMPLE_SIZE, type=int), MAX_LATENCY_SAMPLE_SIZE)
+    if sample < 1:
+        return jsonify({'error': 'sample must be a positive number'}), 400
+
     session = get_session()
     try:
-        # Return all executions for all users regardless of admin status
-        executions = session.query(CommandExecution).order_by(CommandExecution.start_time.desc()).all()
-        
-        result = []
-        for exe in executions:
-            result.append({
-                'id': exe.id,
-                'command_name': exe.command_name,
-                'target_host': exe.target_host,
-                'status': exe.status,
-                'start_time': exe.start_time.isoformat() if exe.start_time else None,
-                'end_time': exe.end_time.isoformat() if exe.end_time else None,
-                'exit_code': exe.exit_code,
-                'user': exe.user
-            })
-        
-        return jsonify({'executions': result}), 200
+        query = filter_executions(session.query(ExecutionTiming).join(CommandExecution), request.args)
+        timings = query.order_by(ExecutionTiming.submitted_at.desc()).limit(sample).all()
+        return jsonify({
+            'sample_size': len(timings),
+            'percentiles': list(PERCENTILES),
+            'phases': summarize(timings)
+        }), 200
     except Exception as e:
-        return jsonify({'error': f'Error fetching executions: {str(e)}'}), 500
+        return jsonify({'error': f'Error fetching execution latency: {str(e)}'}), 500
     finally:
         session.remove()
 
@@ -0,0 +1,69 @@
+# web_api/routing.py
+"""
+Which Celery queue an execution is sent to.
+
+Executions are split by command class so a few long-running commands can't
+take every worker slot while quick probes wait behind them:
+
+- interactive: everything not listed in COMMAND_CLASSES
+- long: commands known to run for a long time
+- bulk: executions created by fan-outs and other batch submissions
+
+Hosts listed in HOST_QUEUES get a queue of their own ("host.<name>"), so a
+slow or overloaded host only delays its own executions. Workers choose the
+queues they consume with WORKER_QUEUES (see start_worker.py) and always add
+the host queues, so HOST_QUEUES must be set the same way for the web app,
+the scheduler and every worker.
+"""
+import os
+import json
+from kombu import Queue
+
+INTERACTIVE_QUEUE = 'interactive'
+LONG_QUEUE = 'long'
+BULK_QUEUE = 'bulk'
+# Where tasks went before routing existed; kept so queued messages still get consumed
+LEGACY_QUEUE = 'celery'
+
+# Command name -> class ("interactive", "long" or "bulk")
+COMMAND_CLASSES = json.loads(os.getenv('COMMAND_CLASSES', '{"long_running_task.sh": "long"}'))
+
+# Hosts whose executions go to their own queue, e.g. HOST_QUEUES='["hermes_target_beta"]'.
+# Workers consume these queues on top of WORKER_QUEUES, but only if they see the same list.
+HOST_QUEUES = json.loads(os.getenv('HOST_QUEUES', '[]'))
+
+CLASS_QUEUES = (INTERACTIVE_QUEUE, LONG_QUEUE, BULK_QUEUE)
+
+def host_queue(host):
+    return f"host.{host}"
+
+def queue_for(command_name, target_host, bulk=False):
+    """The queue an execution of `command_name` on `target_host` is sent to."""
+    if target_host in HOST_QUEUES:
+        return host_queue(target_host)
+    if bulk:
+        return BULK_QUEUE
+    command_class = COMMAND_CLASSES.get(command_name, INTERACTIVE_QUEUE)
+    return command_class if command_class in CLASS_QUEUES else INTERACTIVE_QUEUE
+
+def host_queues():
+    return [host_queue(host) for host in HOST_QUEUES]
+
+def all_queues():
+    """Names of every queue executions can be sent to."""
+    return list(CLASS_QUEUES) + host_queues() + [LEGACY_QUEUE]
+
+def task_queues():
+    """Queue declarations for the Celery configuration."""
+    return [Queue(name, routing_key=name) for name in all_queues()]
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    """
+    Celery router (task_routes). A queue given explicitly when sending, e.g.
+    by a fan-out, takes precedence over the one returned here.
+    """
+    if name != 'execute_command':
+        return None
+    command_name = kwargs.get('command_name', args[1] if len(args) > 1 else None)
+    target_host = kwargs.get('target_host', args[2] if len(args) > 2 else None)
+    return {'queue': queue_for(command_name, target_host)}
@@ -0,0 +1,279 @@
+# web_api/scheduler.py
+"""
+Recurring executions (ScheduledJob), dispatched by one leader process.
+
+Every scheduler process (start_scheduler.py) competes for a lease row in
+scheduler_leases; only the holder dispatches, and a standby takes over once
+the lease expires. A job fires on an interval or on a cron expression (the
+latter needs the optional croniter package); times are UTC.
+
+Within one firing each host starts at its own offset into a window of up to
+jitter_seconds. The offset is derived from the job and the host name, so it
+is the same at every firing, and hundreds of hosts don't reach the broker,
+the workers and SQLite in the same second. A host whose previous execution of
+the job is still pending or running is skipped for that firing.
+
+Firings missed while no scheduler was running follow the job's catch_up policy:
+
+- skip: forget them and wait for the next regular firing
+- once: fire once now, then continue with the regular schedule (default)
+- all: replay them one per tick, at most SCHEDULER_MAX_CATCH_UP of them
+  (with 0, like skip)
+"""
+import os
+import json
+import time
+import socket
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, or_
+from sqlalchemy.exc import IntegrityError
+from models import CommandExecution, ScheduledJob, SchedulerLease
+from coalesce import IN_FLIGHT_STATUSES
+from dispatch import resolve_hosts, create_executions, dispatch_lanes
+from timings import create_timings, utcnow
+from storage import get_session
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Cron expressions are optional; without croniter only interval jobs can be created
+try:
+    from croniter import croniter
+except ImportError:
+    croniter = None
+
+CATCH_UP_POLICIES = ('skip', 'once', 'all')
+
+# How often (seconds) the leader looks for due jobs
+SCHEDULER_TICK = float(os.getenv('SCHEDULER_TICK', '1'))
+# Seconds a leader holds the lease without renewing it; a standby takes over after that
+SCHEDULER_LEASE_SECONDS = int(os.getenv('SCHEDULER_LEASE_SECONDS', '15'))
+# A firing whose window ended more than this many seconds ago was missed, not just late
+SCHEDULER_MISFIRE_GRACE = int(os.getenv('SCHEDULER_MISFIRE_GRACE', '60'))
+# Most missed firings replayed by catch_up="all"; 0 replays none
+SCHEDULER_MAX_CATCH_UP = int(os.getenv('SCHEDULER_MAX_CATCH_UP', '10'))
+# Executions older than this don't count as in flight (e.g. rows whose task was never sent)
+SCHEDULER_STALE_AFTER = int(os.getenv('SCHEDULER_STALE_AFTER', '7200'))
+# The jitter window is capped at this fraction of the time between two firings
+SCHEDULER_MAX_SPREAD = 0.5
+
+LEASE_NAME = 'scheduler'
+
+def validate_schedule(interval_seconds=None, cron=None, catch_up='once', jitter_seconds=0):
+    """Raise ValueError if the schedule settings of a job are unusable."""
+    try:
+        interval_seconds = int(interval_seconds) if interval_seconds is not None else None
+        jitter_seconds = int(jitter_seconds or 0)
+    except (TypeError, ValueError):
+        raise ValueError("interval_seconds and jitter_seconds must be whole numbers")
+    if bool(interval_seconds) == bool(cron):
+        raise ValueError("Exactly one of interval_seconds and cron is required")
+    if interval_seconds is not None and interval_seconds < 1:
+        raise ValueError("interval_seconds must be at least 1")
+    if cron:
+        if croniter is None:
+            raise ValueError("Cron schedules need the croniter package")
+        if not isinstance(cron, str) or not croniter.is_valid(cron):
+            raise ValueError(f"Invalid cron expression: {cron}")
+    if catch_up not in CATCH_UP_POLICIES:
+        raise ValueError(f"catch_up must be one of {', '.join(CATCH_UP_POLICIES)}")
+    if jitter_seconds < 0:
+        raise ValueError("jitter_seconds can't be negative")
+
+def next_firing(job, after):
+    """The first regular firing of `job` strictly after `after`."""
+    if job.cron:
+        return croniter(job.cron, after).get_next(datetime)
+    # Interval firings are anchored at the job's creation, so they keep their phase
+    anchor = job.created_at or datetime(1970, 1, 1)
+    if after < anchor:
+        return anchor
+    periods = int((after - anchor).total_seconds() // job.interval_seconds) + 1
+    return anchor + timedelta(seconds=periods * job.interval_seconds)
+
+def earliest_catch_up(job, firing, now):
+    """The oldest of the last SCHEDULER_MAX_CATCH_UP regular firings before `now`, but not before `firing`."""
+    if job.cron:
+        previous = croniter(job.cron, now)
+        for _ in range(SCHEDULER_MAX_CATCH_UP):
+            earliest = previous.get_prev(datetime)
+    else:
+        last = next_firing(job, now) - timedelta(seconds=job.interval_seconds)
+        earliest = last - timedelta(seconds=(SCHEDULER_MAX_CATCH_UP - 1) * job.interval_seconds)
+    return max(firing, earliest)
+
+def jitter_window(job, firing):
+    """Seconds over which the hosts of `firing` are spread."""
+    gap = (next_firing(job, firing) - firing).total_seconds()
+    return max(0.0, min(float(job.jitter_seconds or 0), gap * SCHEDULER_MAX_SPREAD))
+
+def host_offset(job, host, window):
+    """Where in the window `host` starts: fixed for a job and host, spread evenly over the hosts."""
+    digest = hashlib.sha256(f"{job.id}:{host}".encode()).digest()
+    return window * int.from_bytes(digest[:8], 'big') / 2 ** 64
+
+def job_hosts(job):
+    return resolve_hosts(json.loads(job.target_hosts) if job.target_hosts else None, job.host_group)
+
+def due_hosts(job, now):
+    """
+    The hosts of `job` to start at `now`. Moves the job's schedule state on:
+    how far into the current firing's window hosts were started, and the next
+    firing once the window has passed. The caller commits.
+    """
+    if job.next_run_at is None:
+        job.next_run_at = next_firing(job, job.created_at or now)
+    firing = job.next_run_at
+    if firing > now:
+        return []
+
+    if job.dispatched_through is None and now - (firing + timedelta(seconds=jitter_window(job, firing))) \
+            > timedelta(seconds=SCHEDULER_MISFIRE_GRACE):
+        # Nothing of this firing was started: no scheduler was running at the time
+        if job.catch_up == 'skip' or (job.catch_up == 'all' and SCHEDULER_MAX_CATCH_UP < 1):
+            logger.info(f"Job {job.name}: skipping firings missed since {firing}")
+            job.next_run_at = next_firing(job, now)
+            return []
+        if job.catch_up == 'all':
+            firing = job.next_run_at = earliest_catch_up(job, firing, now)
+            logger.info(f"Job {job.name}: replaying missed firing of {firing}")
+        else:
+            logger.info(f"Job {job.name}: firing once for the firings missed since {firing}")
+            firing = job.next_run_at = now
+
+    window = jitter_window(job, firing)
+    started_through = job.dispatched_through
+    due = []
+    for host in job_hosts(job):
+        starts_at = firing + timedelta(seconds=host_offset(job, host, window))
+        if starts_at <= now and (started_through is None or starts_at > started_through):
+            due.append(host)
+
+    if now >= firing + timedelta(seconds=window):
+        # Every host of this firing was started
+        job.last_run_at = firing
+        job.next_run_at = next_firing(job, firing)
+        job.dispatched_through = None
+    else:
+        job.dispatched_through = now
+    return due
+
+def in_flight_hosts(session, job, hosts, now):
+    """The hosts among `hosts` whose previous execution of `job` is still pending or running."""
+    return set(session.scalars(
+        select(CommandExecution.target_host).where(
+            CommandExecution.job_id == job.id,
+            CommandExecution.target_host.in_(hosts),
+            CommandExecution.status.in_(IN_FLIGHT_STATUSES),
+            CommandExecution.start_time > now - timedelta(seconds=SCHEDULER_STALE_AFTER)
+        )
+    ).all())
+
+def run_job(session, job, now):
+    """Start the executions of `job` that are due at `now`. Returns their ids."""
+    hosts = due_hosts(job, now)
+    busy = in_flight_hosts(session, job, hosts, now) if hosts else set()
+    if busy:
+        logger.info(f"Job {job.name}: skipping hosts still running the previous firing: {sorted(busy)}")
+    hosts = [host for host in hosts if host not in busy]
+
+    execution_ids = create_executions(session, [
+        {'command_name': job.command_name, 'target_host': host, 'user': job.user, 'job_id': job.id,
+         'params': job.params}
+        for host in hosts
+    ])
+    create_timings(session, execution_ids)
+    # The schedule state is committed with the executions, so a new leader neither repeats nor loses them
+    session.commit()
+
+    if execution_ids:
+        params = json.loads(job.params) if job.params else []
+        dispatch_lanes([
+            (execution_id, job.command_name, host, params, job.user)
+            for execution_id, host in zip(execution_ids, hosts)
+        ], len(execution_ids))
+    for host in hosts:
+        metrics.EXECUTIONS_SUBMITTED.labels(job.command_name, host, 'scheduled').inc()
+    for host in busy:
+        metrics.EXECUTIONS_SUBMITTED.labels(job.command_name, host, 'skipped_in_flight').inc()
+    return execution_ids
+
+def tick(session, now=None):
+    """Run every enabled job that is due."""
+    now = now or utcnow()
+    jobs = session.scalars(
+        select(ScheduledJob).where(
+            ScheduledJob.enabled.is_(True),
+            or_(ScheduledJob.next_run_at.is_(None), ScheduledJob.next_run_at <= now)
+        )
+    ).all()
+    for job in jobs:
+        try:
+            run_job(session, job, now)
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Job {job.name} failed to dispatch: {e}")
+
+def hold_lease(session, holder, now=None, name=LEASE_NAME):
+    """Take or renew the lease for `holder`. Returns True if it is the leader for the next SCHEDULER_LEASE_SECONDS."""
+    now = now or utcnow()
+    expires_at = now + timedelta(seconds=SCHEDULER_LEASE_SECONDS)
+    result = session.execute(
+        update(SchedulerLease)
+        .where(SchedulerLease.name == name,
+               or_(SchedulerLease.holder == holder, SchedulerLease.expires_at < now))
+        .values(holder=holder, expires_at=expires_at)
+    )
+    if result.rowcount == 0 and session.get(SchedulerLease, name) is None:
+        session.add(SchedulerLease(name=name, holder=holder, expires_at=expires_at))
+        try:
+            session.commit()
+            return True
+        except IntegrityError:
+            # Another scheduler created it first
+            session.rollback()
+            return False
+    session.commit()
+    return result.rowcount == 1
+
+def release_lease(session, holder, name=LEASE_NAME):
+    """Let a standby take over right away instead of waiting for the lease to expire."""
+    session.execute(
+        update(SchedulerLease)
+        .where(SchedulerLease.name == name, SchedulerLease.holder == holder)
+        .values(expires_at=utcnow())
+    )
+    session.commit()
+
+def run(stop_event=None, holder=None):
+    """The scheduler loop: hold the lease and run due jobs every SCHEDULER_TICK seconds."""
+    holder = holder or f"{socket.gethostname()}:{os.getpid()}"
+    Session = get_session()
+    leading = False
+    try:
+        while not (stop_event and stop_event.is_set()):
+            session = Session()
+            try:
+                is_leader = hold_lease(session, holder)
+                if is_leader != leading:
+                    leading = is_leader
+                    logger.info(f"Scheduler {holder} is {'now the leader' if leading else 'on standby'}")
+                if leading:
+                    tick(session)
+            except Exception as e:
+                session.rollback()
+                logger.error(f"Scheduler tick failed: {e}")
+            finally:
+                Session.remove()
+            if stop_event:
+                stop_event.wait(SCHEDULER_TICK)
+            else:
+                time.sleep(SCHEDULER_TICK)
+    finally:
+        if leading:
+            try:
+                release_lease(Session(), holder)
+            finally:
+                Session.remove()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+"""
+Runs the scheduler for recurring executions (see scheduler.py).
+
+Any number of these may run; they elect one leader through the database and
+the others stand by until its lease expires.
+"""
+import os
+import signal
+import logging
+import threading
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s [%(levelname)s] %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+logger = logging.getLogger(__name__)
+
+# Prometheus metrics of the scheduler (executions scheduled or skipped); 0 to disable
+SCHEDULER_METRICS_PORT = int(os.environ.get('SCHEDULER_METRICS_PORT', '9102'))
+
+import scheduler
+from metrics import start_worker_metrics_server
+
+if __name__ == '__main__':
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+
+    if start_worker_metrics_server(SCHEDULER_METRICS_PORT):
+        logger.info(f"Scheduler metrics available on port {SCHEDULER_METRICS_PORT}")
+
+    logger.info(f"Starting scheduler (tick {scheduler.SCHEDULER_TICK}s, lease {scheduler.SCHEDULER_LEASE_SECONDS}s)")
+    scheduler.run(stop)
+    logger.info("Scheduler stopped")
@@ -21,6 +21,12 @@ logger = logging.getLogger(__name__)
 # Set default hostname if not provided
 worker_name = os.environ.get('WORKER_NAME', 'worker')
 
+# Comma-separated queues this worker consumes (see routing.py); empty for all of them.
+# The host.<name> queues of HOST_QUEUES are always added, or their executions would stay pending.
+worker_queues = os.environ.get('WORKER_QUEUES', '')
+# Tasks the worker runs at once; empty for the Celery configuration's default
+worker_concurrency = os.environ.get('WORKER_CONCURRENCY', '')
+
 # Configure startup delay based on worker name or environment variable
 startup_delay = int(os.environ.get('WORKER_STARTUP_DELAY', '0'))
 retry_max_attempts = int(os.environ.get('WORKER_RETRY_ATTEMPTS', '15'))
@@ -114,6 +120,8 @@ logger.info(f"Delay complete, starting worker {worker_name}...")
 
 # Import Celery app
 from extensions import celery_app
+from metrics import start_worker_metrics_server, WORKER_METRICS_PORT
+from routing import all_queues, host_queues
 
 if __name__ == '__main__':
     # Build the Celery worker command
@@ -127,7 +135,22 @@ if __name__ == '__main__':
     
     # Always add hostname for clarity in logs
     args.append(f'--hostname={worker_name}@%h')
+
+    # Without WORKER_QUEUES, consume every queue executions can be routed to
+    queues = [queue.strip() for queue in worker_queues.split(',') if queue.strip()] or all_queues()
+    missing = [queue for queue in host_queues() if queue not in queues]
+    if missing:
+        logger.info(f"Also consuming the host queues {missing} (HOST_QUEUES)")
+        queues += missing
+    queues = ','.join(queues)
+    args.extend(['-Q', queues])
+    if worker_concurrency:
+        args.extend(['-c', worker_concurrency])
     
+    # Serve this worker's Prometheus metrics next to it
+    if start_worker_metrics_server():
+        logger.info(f"Worker metrics available on port {WORKER_METRICS_PORT}")
+
     # Start the worker
-    logger.info(f"Starting Celery worker: {worker_name}")
+    logger.info(f"Starting Celery worker: {worker_name} (queues: {queues})")
     celery_app.worker_main(args) 
\ No newline at end of file
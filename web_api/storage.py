@@ -0,0 +1,91 @@
+# web_api/storage.py
+"""
+Database engine and sessions shared by everything in one process.
+
+Each process (the web app, every worker) uses a single engine with a
+connection pool and a single scoped_session registry, instead of building a
+sessionmaker per request. SQLite connections are tuned for many concurrent
+readers and a steady stream of small writes: WAL journaling, a busy timeout
+instead of immediate "database is locked" errors, synchronous=NORMAL and
+memory-mapped reads. Any other SQLAlchemy URL (e.g. PostgreSQL) works as
+well and gets a regular pool.
+"""
+import os
+import sqlite3
+import logging
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DATABASE_URL = (
+    f"sqlite:///{os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'hermes_lite.db'))}"
+)
+DATABASE_URL = os.getenv('DATABASE_URL', DEFAULT_DATABASE_URL)
+
+# SQLite tuning, applied to every new connection
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '10000'))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+
+# Connections kept open per process, and how many more may be opened under load
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '20'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))  # seconds; ignored for SQLite
+
+@event.listens_for(Engine, 'connect')
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """Tune each new SQLite connection; other databases are left alone."""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    finally:
+        cursor.close()
+
+def engine_options(url=DATABASE_URL):
+    """Keyword arguments for create_engine() (or SQLALCHEMY_ENGINE_OPTIONS) for `url`."""
+    options = {'pool_pre_ping': True}
+    backend = make_url(url).get_backend_name()
+    if backend == 'sqlite':
+        # The busy timeout is also set as a pragma; this covers the driver's own locking
+        options['connect_args'] = {'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000}
+        if make_url(url).database not in (None, '', ':memory:'):
+            options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+    else:
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_recycle=DB_POOL_RECYCLE)
+    return options
+
+_engine = None
+
+# One registry per process; each thread (or greenlet) gets its own session from it
+Session = scoped_session(sessionmaker())
+
+def use_engine(engine):
+    """Make `engine` the process-wide engine, e.g. the one Flask-SQLAlchemy created."""
+    global _engine
+    _engine = engine
+    Session.remove()
+    Session.configure(bind=engine)
+    return engine
+
+def get_engine():
+    """Return the process-wide engine, creating it from DATABASE_URL on first use."""
+    if _engine is None:
+        use_engine(create_engine(DATABASE_URL, **engine_options(DATABASE_URL)))
+        logger.info(f"Database engine created for {make_url(DATABASE_URL).render_as_string(hide_password=True)}")
+    return _engine
+
+def get_session():
+    """
+    Return the scoped session registry. Calling it gives the current
+    thread's session; call .remove() on it when the unit of work is done.
+    """
+    get_engine()
+    return Session
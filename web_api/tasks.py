@@ -1,47 +1,20 @@
-import subprocess
 import time
-import requests
-import json
 import os
+import random
 import logging
-import socketio as socketio_client
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy import select
 from sqlalchemy.sql import func
-from extensions import celery_app as celery, socketio
-from models import CommandExecution
-import re
-
-# Try to import flag_modified, but provide a fallback if it doesn't exist
-try:
-    from sqlalchemy.orm import flag_modified
-    has_flag_modified = True
-except ImportError:
-    has_flag_modified = False
-    # Define a simple replacement function that will work with older SQLAlchemy versions
-    def flag_attribute_modified(obj, attr_name):
-        """Mark an attribute as modified on an object manually."""
-        try:
-            # Standard SQLAlchemy approach
-            obj._sa_instance_state.modified.add(attr_name)
-        except (AttributeError, TypeError):
-            # Fallback for when modified is not a set or doesn't have add method
-            # Just force a commit with the current value to ensure it's saved
-            logger.warning(f"Couldn't directly mark attribute '{attr_name}' as modified, using alternative approach")
-            try:
-                # For SQLAlchemy >= 1.4
-                from sqlalchemy import inspect
-                insp = inspect(obj)
-                if hasattr(insp, "add_attribute_change"):
-                    insp.add_attribute_change(attr_name, None, getattr(obj, attr_name, None))
-                    return True
-            except (ImportError, AttributeError):
-                pass
-            
-            # Last resort: just touch the attribute to make SQLAlchemy notice the change
-            current_value = getattr(obj, attr_name, None)
-            setattr(obj, attr_name, current_value)
-        return True
+from celery.worker.control import inspect_command
+from extensions import celery_app as celery
+import agent_client
+from models import CommandExecution, FINISHED_STATUSES
+from output_store import OutputBuffer, finalize_output
+from agent_protocol import REQUEST_HEADERS, decode_stream
+from coalesce import sync_followers, dispatch_promoted
+from timings import get_timing, utcnow, from_epoch
+from storage import get_session, get_engine
+from realtime import sender as realtime_sender
+import metrics
 
 # Set up logging
 logging.basicConfig(
@@ -50,242 +23,286 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Create a direct SQLAlchemy engine
-DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///data/hermes_lite.db')
-engine = create_engine(DATABASE_URL)
-SessionFactory = sessionmaker(bind=engine)
-
-# SocketIO client for workers
-sio_client = None
-SOCKETIO_READY = False
+# Retrying executions refused by a busy agent (HTTP 429)
+AGENT_BUSY_MAX_RETRIES = int(os.environ.get('AGENT_BUSY_MAX_RETRIES', '10'))
+AGENT_BUSY_BACKOFF = float(os.environ.get('AGENT_BUSY_BACKOFF', '2'))  # seconds, doubled on every retry
+AGENT_BUSY_MAX_BACKOFF = float(os.environ.get('AGENT_BUSY_MAX_BACKOFF', '60'))
 
-def init_socketio_client():
-    """Initialize a socketio client that workers can use to communicate with the Flask app."""
-    global sio_client
-    global SOCKETIO_READY
-    
-    try:
-        # Create a new socket.io client
-        sio_client = socketio_client.Client(
-            logger=False,
-            engineio_logger=False,
-            reconnection=True,
-            reconnection_attempts=5,
-            reconnection_delay=1,
-            reconnection_delay_max=5,
-            randomization_factor=0.5
-        )
-        
-        # Define event handlers
-        @sio_client.event(namespace='/realtime')
-        def connect():
-            global SOCKETIO_READY
-            logger.info(f"Worker {os.environ.get('WORKER_NAME', 'worker')}: Connected to SocketIO server")
-            SOCKETIO_READY = True
+# How often (seconds) a streaming run checks whether it was cancelled, in case the
+# agent couldn't be told directly (POST /cancel on the agent is the fast path)
+CANCEL_CHECK_INTERVAL = float(os.environ.get('CANCEL_CHECK_INTERVAL', '5'))
 
-        @sio_client.event(namespace='/realtime')
-        def connect_error(data):
-            global SOCKETIO_READY
-            logger.error(f"Worker {os.environ.get('WORKER_NAME', 'worker')}: Connection error to SocketIO server: {data}")
-            SOCKETIO_READY = False
-
-        @sio_client.event(namespace='/realtime')
-        def disconnect():
-            global SOCKETIO_READY
-            logger.warning(f"Worker {os.environ.get('WORKER_NAME', 'worker')}: Disconnected from SocketIO server")
-            SOCKETIO_READY = False
-        
-        @sio_client.event(namespace='/realtime')
-        def welcome(data):
-            logger.info(f"Worker received welcome message: {data}")
-        
-        # Connect to the Flask app's socket.io server
-        server_url = os.environ.get('SOCKETIO_SERVER', 'http://web:5000')
-        logger.info(f"Worker {os.environ.get('WORKER_NAME', 'worker')}: Connecting to Socket.IO server at {server_url}")
-        sio_client.connect(
-            server_url,
-            namespaces=['/realtime'],
-            transports=['websocket'],
-            wait=True
-        )
-        
-        return True
-    except Exception as e:
-        logger.error(f"Error initializing Socket.IO client: {e}")
-        SOCKETIO_READY = False
-        return False
+# Final statuses of runs the agent stopped, by the reason in its exit record
+STOPPED_STATUSES = ('cancelled', 'timeout')
 
 def safe_emit(event, data, execution_id=None):
-    """Safely emit a socket.io event, with fallback mechanisms."""
-    global sio_client
-    global SOCKETIO_READY
-    
-    # Get the room name for this execution
-    room = f"exec_{execution_id}" if execution_id else None
-    
-    # Add metadata to the event
+    """
+    Queue a realtime event for the browsers following an execution. Never
+    blocks; returns False if the event was dropped because too many of the
+    execution's events are still waiting to be published. Drops and failed
+    publishes are counted by the sender, not written to the output.
+    """
     data.update({
         'source': f"worker_{os.environ.get('WORKER_NAME', 'worker')}",
-        'event_time': time.strftime('%Y-%m-%d %H:%M:%S'),
-        'from_client': True
+        'event_time': time.strftime('%Y-%m-%d %H:%M:%S')
     })
-    
-    # Try using the client socket.io connection 
-    if SOCKETIO_READY and sio_client:
-        try:
-            sio_client.emit(event, data, namespace='/realtime')
-            return True
-        except Exception as e:
-            logger.error(f"Error emitting {event} via client: {e}")
-            SOCKETIO_READY = False
-    
-    # If we have execution_id but socket.io isn't ready, try using server-side socketio
-    if execution_id and not SOCKETIO_READY:
-        try:
-            if socketio:
-                socketio.emit(event, data, namespace='/realtime', room=room)
-                return True
-        except Exception as e:
-            logger.error(f"Error emitting using server-side socketio: {e}")
-    
-    # Try to reconnect the client if it's not ready
-    if not SOCKETIO_READY or not sio_client:
-        logger.warning(f"Worker {os.environ.get('WORKER_NAME', 'worker')}: Socket.IO not available for emitting")
-        success = init_socketio_client()
-        
-        if success and execution_id:
-            try:
-                sio_client.emit('join', {'execution_id': execution_id}, namespace='/realtime')
-                sio_client.emit(event, data, namespace='/realtime')
-                return True
-            except Exception as e:
-                logger.error(f"Error joining room after reconnect: {e}")
-    
-    # Persist error in database if we have an execution ID
-    if execution_id:
-        try:
-            Session = scoped_session(SessionFactory)
-            session = Session()
-            execution = session.query(CommandExecution).filter_by(id=execution_id).first()
-            if execution:
-                execution.output += f"\n[ERROR] Failed to stream output in real-time"
-                session.commit()
-        except Exception as db_error:
-            logger.error(f"Error updating execution record: {db_error}")
-        finally:
-            Session.remove()
-    
-    return False
+    return realtime_sender.submit(event, data, execution_id)
+
+@inspect_command()
+def agent_pool_stats(state):
+    """
+    Connection reuse of this worker's agent pools:
+    celery -A extensions.celery_app inspect agent_pool_stats
+    """
+    return agent_client.pool_stats()
+
+# The sender's counters are also scraped from the worker's metrics listener
+metrics.register_realtime_sender(realtime_sender)
 
-# Attempt to initialize the socketio client when this module is imported
-try:
-    init_socketio_client()
-except Exception as e:
-    logger.error(f"Failed to initialize SocketIO client on module import: {e}")
+@inspect_command()
+def realtime_stats(state):
+    """
+    Queued, sent, dropped, coalesced and delayed realtime events of this worker:
+    celery -A extensions.celery_app inspect realtime_stats
+    """
+    return realtime_sender.stats()
 
-@celery.task(name="execute_command")
-def execute_command(execution_id, command_name, target_host, params=None, user=None):
-    """Execute a command on a target host."""
+def mark_persisted(session, timing):
+    """Record that the final result was committed. Best effort: the result itself is already safe."""
+    try:
+        timing.persisted_at = utcnow()
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Failed to record persist time of execution {timing.execution_id}: {e}")
+
+def cancel_requested(execution_id):
+    """
+    True if POST /cancel was called for the execution. Read on its own
+    connection: the task's session may be holding an older snapshot.
+    """
+    with get_engine().connect() as conn:
+        return conn.scalar(
+            select(CommandExecution.cancel_requested_at).where(CommandExecution.id == execution_id)
+        ) is not None
+
+def busy_retry_delay(response, retries):
+    """
+    Seconds to wait before asking a busy agent again: exponential backoff with
+    jitter, but never sooner than the agent's Retry-After.
+    """
+    try:
+        retry_after = float(response.headers.get('Retry-After', 0))
+    except ValueError:
+        retry_after = 0
+    backoff = min(AGENT_BUSY_MAX_BACKOFF, AGENT_BUSY_BACKOFF * (2 ** retries))
+    return max(retry_after, backoff) + random.uniform(0, AGENT_BUSY_BACKOFF)
+
+# Results are never read back (progress lives in CommandExecution), so don't store them
+@celery.task(name="execute_command", bind=True, ignore_result=True)
+def execute_command(self, execution_id, command_name, target_host, params=None, user=None, submitted_at=None):
+    """
+    Execute a command on a target host.
+    submitted_at is the epoch time the execution was requested, for the queue
+    wait metric and for executions created without a timing row.
+    """
     if params is None:
         params = []
+    retry_delay = None
+    labels = (command_name, target_host)
+    if submitted_at and not self.request.retries:
+        metrics.QUEUE_WAIT.labels(*labels).observe(max(0, time.time() - submitted_at))
     
-    Session = scoped_session(SessionFactory)
+    Session = get_session()
     session = Session()
     
     try:
         # Get the execution record
         execution = session.query(CommandExecution).filter_by(id=execution_id).first()
         
-        if execution:
+        if execution and (execution.status in FINISHED_STATUSES or execution.cancel_requested_at is not None):
+            # Cancelled while it was still queued (or waiting to be retried)
+            logger.info(f"Execution {execution_id} was cancelled before it started")
+            if execution.status not in FINISHED_STATUSES:
+                execution.status = 'cancelled'
+                execution.end_time = func.now()
+                promoted = sync_followers(session, execution)
+                session.commit()
+                dispatch_promoted(promoted)
+                safe_emit('execution_update', {'execution_id': execution_id, 'status': 'cancelled'},
+                          execution_id=execution_id)
+            return False
+        elif execution:
+            # Output is appended as chunks and committed in time/size bounded batches
+            output_buffer = OutputBuffer(
+                session, execution_id,
+                commit_observer=metrics.DB_COMMIT.labels(command_name, target_host, 'output').observe
+            )
+
+            # Lifecycle timestamps; the first pick-up is when the task left the queue.
+            # start_time stays the submission time.
+            timing = get_timing(session, execution_id)
+            if timing.submitted_at is None and submitted_at:
+                timing.submitted_at = from_epoch(submitted_at)
+            if timing.dequeued_at is None:
+                timing.dequeued_at = utcnow()
+            timing.attempts = (timing.attempts or 0) + 1
+
             # Update the execution status
             execution.status = 'running'
-            execution.start_time = func.now()
-            session.commit()
+            sync_followers(session, execution)
+            with metrics.timed_commit(command_name, target_host, 'status'):
+                session.commit()
             
-            # Make API call to the agent on the target host
-            agent_url = f"http://{target_host}:9000/execute"
+            # Make API call to the agent on the target host over a pooled connection
             payload = {
                 'command_name': command_name,
                 'params': params,
                 'execution_id': str(execution_id)
             }
             
-            response = requests.post(agent_url, json=payload, stream=True)
+            agent_called_at = time.monotonic()
+            response = agent_client.post(target_host, '/execute', json=payload, headers=REQUEST_HEADERS, stream=True)
             
             # Stream response back for real-time feedback
             if response.status_code == 200:
+                # Committed along with the first batch of output
+                timing.agent_connected_at = utcnow()
+
                 # Mark the beginning of streaming
                 streaming_message = f"Starting execution of command: {command_name}"
-                safe_emit('execution_output', 
-                          {'execution_id': execution_id, 'output_line': streaming_message}, 
+                safe_emit('execution_output',
+                          {'execution_id': execution_id, 'output_line': streaming_message},
                           execution_id=execution_id)
 
                 # Update execution with streaming message
-                execution.output = streaming_message + "\n"
-                session.commit()
+                output_buffer.append(streaming_message, stream='system')
                 
-                # Process streaming response
+                # Process streaming response: output, heartbeats and the final exit code
                 exit_code = None
-                exit_code_pattern = re.compile(r'\[EXIT_CODE:(\d+)\]')
+                exit_reason = None
+                agent_error = None
+                cancelled = False
+                next_cancel_check = time.monotonic() + CANCEL_CHECK_INTERVAL
+                first_record_at = first_output_at = None
+                line_count = byte_count = 0
+                lines_metric = metrics.OUTPUT_LINES.labels(*labels)
+                bytes_metric = metrics.OUTPUT_BYTES.labels(*labels)
                 
-                for line in response.iter_lines(decode_unicode=True):
-                    if line:
-                        # Check if this line contains an exit code
-                        exit_code_match = exit_code_pattern.search(line)
-                        if exit_code_match:
-                            exit_code = int(exit_code_match.group(1))
-                            logger.info(f"Extracted exit code {exit_code} from output")
-                        
-                        # Add line to execution output
-                        if execution.output:
-                            execution.output += f"\n{line}"
-                        else:
-                            execution.output = line
-                            
-                        # Use flag_modified if available for SQLAlchemy ORM
-                        if has_flag_modified:
-                            flag_modified(execution, 'output')
-                        else:
-                            flag_attribute_modified(execution, 'output')
-                        
-                        session.commit()
-                        
-                        # Emit to socket.io for real-time updates
-                        safe_emit('execution_output', 
-                                  {'execution_id': execution_id, 'output_line': line}, 
-                                  execution_id=execution_id)
+                for event in decode_stream(response, command_name):
+                    if first_record_at is None:
+                        first_record_at = time.monotonic()
+                        metrics.AGENT_FIRST_BYTE.labels(*labels).observe(first_record_at - agent_called_at)
+                    if first_output_at is None and event.kind != 'heartbeat':
+                        first_output_at = timing.first_byte_at = utcnow()
+                    if time.monotonic() >= next_cancel_check:
+                        next_cancel_check = time.monotonic() + CANCEL_CHECK_INTERVAL
+                        if cancel_requested(execution_id):
+                            # Stop reading; closing the stream makes the agent stop the command
+                            cancelled = True
+                            response.close()
+                            output_buffer.append("[INFO] Execution cancelled", stream='system')
+                            break
+                    if event.kind == 'heartbeat':
+                        # Nothing new, but buffered output may have waited long enough
+                        output_buffer.flush_if_due()
+                        continue
+                    if event.kind == 'exit':
+                        exit_code = event.exit_code
+                        exit_reason = event.reason
+                    elif event.kind == 'error':
+                        agent_error = event.line
+                    else:
+                        line_count += 1
+                        byte_count += len(event.line) + 1
+                        lines_metric.inc()
+                        bytes_metric.inc(len(event.line) + 1)
+                    
+                    # Buffer the line; it is committed with its neighbours as one chunk
+                    output_buffer.append(event.line, stream=event.stream)
+                    
+                    # Emit to socket.io for real-time updates. An event dropped
+                    # by a full queue is only counted (realtime_stats, metrics):
+                    # the output itself is stored either way.
+                    safe_emit('execution_output',
+                              {'execution_id': execution_id, 'output_line': event.line},
+                              execution_id=execution_id)
                 
-                # Update execution status to success
-                execution.status = 'success'
-                execution.end_time = func.now()
+                timing.last_byte_at = utcnow()
+
+                if exit_code is None and not cancelled:
+                    # The stream ended without an exit record: the run did not complete
+                    message = agent_error or "[ERROR] Agent stream ended before the command finished"
+                    if not agent_error:
+                        output_buffer.append(message, stream='system')
+                    logger.error(f"Execution {execution_id}: {message}")
                 
-                # Set exit code (may have been parsed from output or set here)
-                if exit_code is not None:
-                    execution.exit_code = exit_code
+                # Write any remaining output and compress the whole of it in the
+                # same commit as the final status
+                output_buffer.flush(commit=False)
+                finalize_output(session, execution)
+
+                # A run succeeds only if the command exited with 0 and wasn't stopped
+                if exit_reason in STOPPED_STATUSES:
+                    final_status = exit_reason
+                elif cancelled:
+                    final_status = 'cancelled'
                 else:
-                    execution.exit_code = 0
-                    
-                session.commit()
+                    final_status = 'success' if exit_code == 0 else 'failure'
+                execution.status = final_status
+                execution.end_time = func.now()
+                execution.exit_code = exit_code if exit_code is not None else 1
+                promoted = sync_followers(session, execution)
+                with metrics.timed_commit(command_name, target_host, 'final'):
+                    session.commit()
+                dispatch_promoted(promoted)
+                mark_persisted(session, timing)
+
+                elapsed = time.monotonic() - agent_called_at
+                metrics.EXECUTION_DURATION.labels(*labels).observe(elapsed)
+                metrics.EXECUTIONS_FINISHED.labels(*labels, final_status).inc()
+                if elapsed > 0:
+                    metrics.OUTPUT_LINE_RATE.labels(*labels).observe(line_count / elapsed)
+                    metrics.OUTPUT_BYTE_RATE.labels(*labels).observe(byte_count / elapsed)
                 
                 # Emit completion update
                 complete_data = {
                     'execution_id': execution_id, 
-                    'status': 'success',
+                    'status': final_status,
+                    'exit_code': execution.exit_code,
                     'end_time': time.strftime('%Y-%m-%d %H:%M:%S')
                 }
                 safe_emit('execution_update', complete_data, execution_id=execution_id)
                 
-                return True
+                return final_status == 'success'
+            elif response.status_code == 429 and self.request.retries < AGENT_BUSY_MAX_RETRIES:
+                # The agent is at capacity: put the execution back to pending and retry later
+                retry_delay = busy_retry_delay(response, self.request.retries)
+                logger.info(f"Agent on {target_host} is busy, retrying execution {execution_id} in {retry_delay:.1f}s")
+                output_buffer.append(
+                    f"[INFO] Agent on {target_host} is busy, retrying in {retry_delay:.0f}s", stream='system'
+                )
+                output_buffer.flush(commit=False)
+                execution.status = 'pending'
+                sync_followers(session, execution)
+                session.commit()
+                safe_emit('execution_update', {'execution_id': execution_id, 'status': 'pending'},
+                          execution_id=execution_id)
             else:
                 error_message = f"[ERROR] Request to agent failed with status code: {response.status_code}, response: {response.text}"
                 logger.error(error_message)
                 
                 # Update execution status to failed
                 execution.status = 'failure'
-                execution.output += f"\n{error_message}"
+                output_buffer.append(error_message, stream='system')
+                output_buffer.flush(commit=False)
+                finalize_output(session, execution)
                 execution.end_time = func.now()
                 execution.exit_code = 1  # Non-zero exit code for failures
+                sync_followers(session, execution)
                 session.commit()
+                mark_persisted(session, timing)
+                metrics.EXECUTIONS_FINISHED.labels(*labels, 'failure').inc()
                 
                 # Emit failure update
                 error_data = {
@@ -307,11 +324,21 @@ def execute_command(execution_id, command_name, target_host, params=None, user=N
         try:
             # Update execution status to failed
             if 'execution' in locals() and execution:
+                session.rollback()
                 execution.status = 'failure'
-                execution.output += f"\n{error_message}"
+                if 'output_buffer' in locals():
+                    # The rollback dropped chunks staged since the last commit
+                    output_buffer.writer.resync()
+                    output_buffer.append(error_message, stream='system')
+                    output_buffer.flush(commit=False)
+                    finalize_output(session, execution)
                 execution.end_time = func.now()
                 execution.exit_code = 1  # Non-zero exit code for failures
+                sync_followers(session, execution)
                 session.commit()
+                if 'timing' in locals():
+                    mark_persisted(session, timing)
+                metrics.EXECUTIONS_FINISHED.labels(*labels, 'failure').inc()
                 
                 # Emit failure update
                 error_data = {
@@ -325,5 +352,13 @@ def execute_command(execution_id, command_name, target_host, params=None, user=N
         
         return False
     finally:
+        # Hand the connection back to the pool (or close it if the stream was cut short)
+        if 'response' in locals():
+            response.close()
         if 'Session' in locals():
             Session.remove()
+
+    # Raised outside the try block so the retry isn't treated as a failure
+    if retry_delay is not None:
+        raise self.retry(countdown=retry_delay, max_retries=AGENT_BUSY_MAX_RETRIES)
+    return False
@@ -0,0 +1,99 @@
+# web_api/timings.py
+"""
+Lifecycle timestamps of executions (ExecutionTiming) and the latency
+breakdown derived from them.
+
+The web app records when an execution was submitted, the worker when it
+dequeued the task, when the agent accepted it, when the first and last output
+arrived and when the final result was committed. The gaps between those
+stages tell broker backlog (queue_wait), a busy or slow agent
+(agent_connect, first_output), the command itself (streaming) and the
+database (persist) apart.
+"""
+from datetime import datetime, timezone
+from sqlalchemy import insert
+from models import ExecutionTiming, utcnow
+
+STAGES = ('submitted', 'dequeued', 'agent_connected', 'first_byte', 'last_byte', 'persisted')
+
+# (phase, from stage, to stage)
+PHASES = (
+    ('queue_wait', 'submitted', 'dequeued'),
+    ('agent_connect', 'dequeued', 'agent_connected'),  # includes waiting out a busy agent
+    ('first_output', 'agent_connected', 'first_byte'),
+    ('streaming', 'first_byte', 'last_byte'),
+    ('persist', 'last_byte', 'persisted'),
+    ('total', 'submitted', 'persisted'),
+)
+
+PERCENTILES = (50, 90, 99)
+
+def from_epoch(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).replace(tzinfo=None)
+
+def create_timings(session, execution_ids, submitted_at=None):
+    """Insert the timing rows of newly submitted executions with one INSERT. The caller commits."""
+    if not execution_ids:
+        return
+    submitted_at = submitted_at or utcnow()
+    session.execute(
+        insert(ExecutionTiming),
+        [{'execution_id': execution_id, 'submitted_at': submitted_at, 'attempts': 0} for execution_id in execution_ids]
+    )
+
+def get_timing(session, execution_id):
+    """The execution's timing row, created if it doesn't exist yet. The caller commits."""
+    timing = session.get(ExecutionTiming, execution_id)
+    if timing is None:
+        timing = ExecutionTiming(execution_id=execution_id, attempts=0)
+        session.add(timing)
+    return timing
+
+def stage_time(timing, stage):
+    return getattr(timing, f"{stage}_at")
+
+def phase_durations(timing):
+    """Seconds spent in each phase; None where a stage is missing."""
+    durations = {}
+    for phase, start, end in PHASES:
+        started, ended = stage_time(timing, start), stage_time(timing, end)
+        durations[phase] = round((ended - started).total_seconds(), 6) if started and ended else None
+    return durations
+
+def serialize_timing(timing):
+    """The timestamps and phase durations of one execution, as returned by /status."""
+    if timing is None:
+        return None
+    result = {}
+    for stage in STAGES:
+        value = stage_time(timing, stage)
+        result[f"{stage}_at"] = value.isoformat() if value else None
+    result['attempts'] = timing.attempts
+    result['phases'] = phase_durations(timing)
+    return result
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an ascending list."""
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[rank - 1]
+
+def summarize(timings, percentiles=PERCENTILES):
+    """
+    Percentiles of every phase over `timings`. Executions that never reached
+    both ends of a phase don't count towards it.
+    """
+    samples = {phase: [] for phase, _, _ in PHASES}
+    for timing in timings:
+        for phase, seconds in phase_durations(timing).items():
+            if seconds is not None:
+                samples[phase].append(seconds)
+
+    summary = {}
+    for phase, values in samples.items():
+        values.sort()
+        summary[phase] = {
+            'count': len(values),
+            **{f"p{p}": (percentile(values, p) if values else None) for p in percentiles},
+            'max': values[-1] if values else None
+        }
+    return summary